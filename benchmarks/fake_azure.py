@@ -0,0 +1,412 @@
+"""
+In-process stand-ins of the subset of the Azure Batch and Blob Storage APIs used by Miriam.
+
+The fakes keep everything in memory and answer with a configurable latency per call, so that Miriam's code paths can
+be measured at scale without any Azure account. Task lists honor the OData filters Miriam emits and are returned in
+pages like the service does. Test logs are generated on demand so that large runs don't hold their logs in memory.
+"""
+
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+import requests
+from azure.batch.models import BatchErrorException, JobState, TaskState, TaskAddStatus
+from azure.common import AzureMissingResourceHttpError
+
+ACCOUNT_NAME = 'fakestorage'
+
+FAKE_SETTINGS = {
+    'gitsource': {'url': 'https://example.com/azure-cli.git', 'branch': 'master'},
+    'azurebatch': {'account': 'fakebatch', 'key': 'fake-key', 'endpoint': 'https://fakebatch.local'},
+    'azurestorage': {'account': ACCOUNT_NAME, 'key': 'ZmFrZS1rZXk='},
+    'automation': {'account': 'sp', 'key': 'password', 'tenant': 'tenant'},
+    'pools': [
+        {'usage': 'build', 'id': 'build-pool', 'sku': 'batch.node.ubuntu 16.04',
+         'image': 'Canonical UbuntuServer 16.04-LTS', 'vmsize': 'Standard_D2_v2', 'dedicated': 1, 'low-pri': 0,
+         'max-tasks': 1},
+        {'usage': 'test', 'id': 'test-pool', 'sku': 'batch.node.ubuntu 16.04',
+         'image': 'Canonical UbuntuServer 16.04-LTS', 'vmsize': 'Standard_D2_v2', 'dedicated': 10, 'low-pri': 0,
+         'max-tasks': 4},
+    ]
+}
+
+MODULES = ['vm', 'network', 'storage', 'keyvault', 'appservice', 'acs', 'sql', 'monitor', 'resource', 'role']
+
+_FILTER_CLAUSE = re.compile(r"^(?P<path>[\w/]+) (?P<op>eq|ne|gt|ge|lt|le) (?P<datetime>datetime)?'?(?P<value>[^']*)'?$")
+_STARTSWITH_CLAUSE = re.compile(r"^startswith\((?P<path>[\w/]+), ?'(?P<value>[^']*)'\)$")
+
+_OPERATORS = {
+    'eq': lambda a, b: a == b,
+    'ne': lambda a, b: a != b,
+    'gt': lambda a, b: a is not None and a > b,
+    'ge': lambda a, b: a is not None and a >= b,
+    'lt': lambda a, b: a is not None and a < b,
+    'le': lambda a, b: a is not None and a <= b,
+}
+
+_PROPERTIES = {
+    'id': lambda item: item.id,
+    'state': lambda item: item.state.value,
+    'stateTransitionTime': lambda item: item.state_transition_time,
+    'executionInfo/exitCode': lambda item: item.execution_info.exit_code if item.execution_info else None,
+    'executionInfo/result': lambda item: getattr(item.execution_info, 'result', None),
+}
+
+
+def _compile_filter(odata_filter: str):
+    """ Turn the conjunctions of simple comparisons or parenthesized disjunctions Miriam emits into a predicate. """
+    if not odata_filter:
+        return lambda item: True
+
+    predicates = []
+    for clause in odata_filter.split(' and '):
+        clause = clause.strip()
+        if clause.startswith('(') and clause.endswith(')'):
+            alternatives = [_compile_filter(alternative) for alternative in clause[1:-1].split(' or ')]
+            predicates.append(lambda item, a=alternatives: any(predicate(item) for predicate in a))
+            continue
+
+        match = _STARTSWITH_CLAUSE.match(clause)
+        if match:
+            prefix, getter = match.group('value'), _PROPERTIES[match.group('path')]
+            predicates.append(lambda item, g=getter, p=prefix: g(item).startswith(p))
+            continue
+
+        match = _FILTER_CLAUSE.match(clause)
+        if not match:
+            raise ValueError(f'Unsupported filter clause: {clause}')
+        value = match.group('value')
+        if match.group('datetime'):
+            value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+        elif re.match(r'^-?\d+$', value):
+            value = int(value)
+        getter, operator = _PROPERTIES[match.group('path')], _OPERATORS[match.group('op')]
+        predicates.append(lambda item, g=getter, o=operator, v=value: o(g(item), v))
+
+    return lambda item: all(predicate(item) for predicate in predicates)
+
+
+class NotFoundError(BatchErrorException):
+    """ The error raised for a missing job or task. It is caught like any other Batch service error. """
+
+    def __init__(self, message: str):  # pylint: disable=super-init-not-called
+        Exception.__init__(self, message)
+        self.message = message
+
+
+def _not_found(kind: str, name: str) -> NotFoundError:
+    return NotFoundError(f'{kind} {name} is not found.')
+
+
+class FakeBatchService(object):
+    """ The operation groups of BatchServiceClient used by Miriam: job, task, pool and account. """
+
+    def __init__(self, latency: float = 0.0, page_size: int = 1000):
+        self.latency = latency
+        self.page_size = page_size
+        self.calls = Counter()
+        self.jobs = {}
+        self.tasks = {}
+        self.pools = {}
+        self.config = SimpleNamespace(keep_alive=True)
+        self._lock = threading.Lock()
+
+        self.job = SimpleNamespace(add=self._add_job, get=self._get_job, list=self._list_jobs, patch=self._patch_job)
+        self.task = SimpleNamespace(add=self._add_task, add_collection=self._add_task_collection, get=self._get_task,
+                                    list=self._list_tasks)
+        self.pool = SimpleNamespace(add=self._add_pool, get=self._get_pool, resize=self._call('pool.resize'),
+                                    enable_auto_scale=self._call('pool.enable_auto_scale'),
+                                    disable_auto_scale=self._call('pool.disable_auto_scale'))
+        self.account = SimpleNamespace(list_node_agent_skus=self._list_node_agent_skus)
+
+    def record_call(self, operation: str) -> None:
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _call(self, operation: str):
+        def _operation(*_, **__):
+            self.record_call(operation)
+        return _operation
+
+    def _add_job(self, job, **_):
+        self.record_call('job.add')
+        self.jobs[job.id] = SimpleNamespace(id=job.id, state=JobState.active, display_name=job.display_name,
+                                            pool_info=job.pool_info, metadata=job.metadata,
+                                            common_environment_settings=job.common_environment_settings,
+                                            job_preparation_task=job.job_preparation_task,
+                                            creation_time=datetime.now(timezone.utc), parameter=job)
+        self.tasks.setdefault(job.id, {})
+
+    def _get_job(self, job_id: str, **_):
+        self.record_call('job.get')
+        if job_id not in self.jobs:
+            raise _not_found('Job', job_id)
+        return self.jobs[job_id]
+
+    def _patch_job(self, job_id: str, job_patch_parameter, **_):
+        self.record_call('job.patch')
+        job = self._get_job(job_id)
+        if job_patch_parameter.on_all_tasks_complete:
+            job.parameter.on_all_tasks_complete = job_patch_parameter.on_all_tasks_complete
+
+    def _list_jobs(self, job_list_options=None, **_):
+        predicate = _compile_filter(job_list_options.filter if job_list_options else None)
+        self.record_call('job.list')
+        return [job for job in self.jobs.values() if predicate(job)]
+
+    def _add_task(self, job_id: str, task, **_):
+        self.record_call('task.add')
+        self._store_task(job_id, task)
+
+    def _add_task_collection(self, job_id: str, value: list, **_):
+        self.record_call('task.add_collection')
+        for task in value:
+            self._store_task(job_id, task)
+        return SimpleNamespace(value=[SimpleNamespace(status=TaskAddStatus.success, task_id=task.id, error=None)
+                                      for task in value])
+
+    def _store_task(self, job_id: str, task) -> None:
+        now = datetime.now(timezone.utc)
+        self.tasks[job_id][task.id] = SimpleNamespace(
+            id=task.id, display_name=task.display_name, command_line=task.command_line, state=TaskState.active,
+            state_transition_time=now, creation_time=now, execution_info=None, node_info=None,
+            environment_settings=getattr(task, 'environment_settings', None),
+            resource_files=getattr(task, 'resource_files', None), output_files=getattr(task, 'output_files', None))
+
+    def _get_task(self, job_id: str, task_id: str, **_):
+        self.record_call('task.get')
+        try:
+            return self.tasks[job_id][task_id]
+        except KeyError:
+            raise _not_found('Task', task_id)
+
+    def _list_tasks(self, job_id: str, task_list_options=None, **_):
+        predicate = _compile_filter(task_list_options.filter if task_list_options else None)
+        page_size = min(self.page_size, (task_list_options.max_results if task_list_options else None) or 1000)
+        tasks = list(self.tasks.get(job_id, {}).values())
+
+        for start in range(0, len(tasks), page_size):
+            self.record_call('task.list')
+            for task in tasks[start:start + page_size]:
+                if predicate(task):
+                    yield task
+
+    def _add_pool(self, pool, **_):
+        self.record_call('pool.add')
+        self.pools[pool.id] = pool
+
+    def _get_pool(self, pool_id: str, **_):
+        self.record_call('pool.get')
+        if pool_id not in self.pools:
+            self.pools[pool_id] = SimpleNamespace(id=pool_id, enable_auto_scale=False)
+        return self.pools[pool_id]
+
+    def _list_node_agent_skus(self, **_):
+        self.record_call('account.list_node_agent_skus')
+        image = SimpleNamespace(publisher='Canonical', offer='UbuntuServer', sku='16.04-LTS')
+        return iter([SimpleNamespace(id='batch.node.ubuntu 16.04', verified_image_references=[image])])
+
+
+class FakeBlobService(object):
+    """
+    The subset of BlockBlobService used by Miriam. A blob is either a string or a callable producing it on demand.
+    FakeBlobService.session serves the blob urls to the code using plain HTTP requests.
+    """
+
+    def __init__(self, latency: float = 0.0, account_name: str = ACCOUNT_NAME):
+        self.latency = latency
+        self.account_name = account_name
+        self.calls = Counter()
+        self.containers = {}
+        self.metadata = {}
+        self._lock = threading.Lock()
+        self.session = FakeBlobSession(self)
+
+    def record_call(self, operation: str) -> None:
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def has_blob(self, container_name: str, blob_name: str = None) -> bool:
+        """ Whether the container or the blob exists, without counting a service call. """
+        container = self.containers.get(container_name)
+        return container is not None and (blob_name is None or blob_name in container)
+
+    def read(self, container_name: str, blob_name: str) -> str:
+        content = self.containers[container_name][blob_name]
+        return content() if callable(content) else content
+
+    def create_container(self, container_name: str, fail_on_exist: bool = False, **_) -> bool:
+        self.record_call('create_container')
+        if container_name in self.containers:
+            return False
+        self.containers[container_name] = {}
+        return True
+
+    def get_container_properties(self, container_name: str, **_):
+        self.record_call('get_container_properties')
+        if container_name not in self.containers:
+            raise AzureMissingResourceHttpError('The container is not found.', 404)
+        return SimpleNamespace(name=container_name)
+
+    def list_containers(self, num_results: int = None, **_):
+        self.record_call('list_containers')
+        return [SimpleNamespace(name=name) for name in sorted(self.containers)][:num_results]
+
+    def exists(self, container_name: str, blob_name: str = None, **_) -> bool:
+        self.record_call('exists')
+        return self.has_blob(container_name, blob_name)
+
+    def list_blobs(self, container_name: str, prefix: str = None, num_results: int = None, **_):
+        names = sorted(name for name in self.containers.get(container_name, {}) if name.startswith(prefix or ''))
+        names = names[:num_results]
+        for start in range(0, len(names), 5000):
+            self.record_call('list_blobs')
+            for name in names[start:start + 5000]:
+                yield SimpleNamespace(name=name)
+
+    def generate_container_shared_access_signature(self, container_name: str, **_) -> str:
+        return f'sv=2016-05-31&sr=c&sig=fake-{container_name}'
+
+    def generate_blob_shared_access_signature(self, container_name: str, blob_name: str, **_) -> str:
+        return f'sv=2016-05-31&sr=b&sig=fake-{container_name}-{blob_name}'
+
+    def make_blob_url(self, container_name: str, blob_name: str, protocol: str = 'https', sas_token: str = None,
+                      **_) -> str:
+        url = f'{protocol or "https"}://{self.account_name}.blob.core.windows.net/{container_name}/{blob_name}'
+        return f'{url}?{sas_token}' if sas_token else url
+
+    def create_blob_from_text(self, container_name: str, blob_name: str, text: str, metadata: dict = None, **_):
+        self.record_call('create_blob_from_text')
+        self.containers.setdefault(container_name, {})[blob_name] = text
+        self.metadata[(container_name, blob_name)] = dict(metadata or {})
+
+    def get_blob_to_text(self, container_name: str, blob_name: str, **_):
+        self.record_call('get_blob_to_text')
+        if not self.has_blob(container_name, blob_name):
+            raise AzureMissingResourceHttpError('The blob is not found.', 404)
+        return SimpleNamespace(name=blob_name, content=self.read(container_name, blob_name))
+
+    def get_blob_metadata(self, container_name: str, blob_name: str, **_) -> dict:
+        self.record_call('get_blob_metadata')
+        if (container_name, blob_name) not in self.metadata:
+            raise AzureMissingResourceHttpError('The blob is not found.', 404)
+        return self.metadata[(container_name, blob_name)]
+
+
+class FakeResponse(object):
+    def __init__(self, url: str, status_code: int, content: bytes = b'', headers: dict = None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.encoding = 'utf-8'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding)
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} for url {self.url}', response=self)
+
+    def iter_lines(self, decode_unicode: bool = False, **_):
+        for line in self.content.splitlines():
+            yield line.decode(self.encoding) if decode_unicode else line
+
+
+class FakeBlobSession(object):
+    """ Serves GET and HEAD requests on the blob urls of a FakeBlobService, including ranged GETs. """
+
+    def __init__(self, storage: FakeBlobService):
+        self.storage = storage
+
+    def _find(self, url: str) -> tuple:
+        container_name, _, blob_name = urlparse(url).path.lstrip('/').partition('/')
+        return container_name, blob_name
+
+    def head(self, url: str, **_) -> FakeResponse:
+        self.storage.record_call('http.head')
+        container_name, blob_name = self._find(url)
+        if not self.storage.has_blob(container_name, blob_name):
+            return FakeResponse(url, 404)
+        size = len(self.storage.read(container_name, blob_name).encode('utf-8'))
+        return FakeResponse(url, 200, headers={'Content-Length': str(size)})
+
+    def get(self, url: str, headers: dict = None, **_) -> FakeResponse:
+        self.storage.record_call('http.get')
+        container_name, blob_name = self._find(url)
+        if not self.storage.has_blob(container_name, blob_name):
+            return FakeResponse(url, 404)
+
+        content = self.storage.read(container_name, blob_name).encode('utf-8')
+        byte_range = (headers or {}).get('x-ms-range') or (headers or {}).get('Range')
+        if byte_range:
+            start, end = (int(value) for value in byte_range[len('bytes='):].split('-'))
+            return FakeResponse(url, 206, content[start:end + 1], {'Content-Length': str(end + 1 - start)})
+        return FakeResponse(url, 200, content, {'Content-Length': str(len(content))})
+
+    def mount(self, *_):
+        pass
+
+
+def _generate_log(task_id: str, lines: int) -> str:
+    preamble = [f'preamble line {index}' for index in range(58)]
+    body = [f'{task_id} log line {index}: ' + 'x' * 60 for index in range(lines)]
+    return '\n'.join(preamble + body + ['----', 'OK', ''])
+
+
+def populate_test_run(batch: FakeBatchService, storage: FakeBlobService, run_id: str, tasks: int = 20000,
+                      failure_rate: float = 0.02, log_lines: int = 200, seed: int = 0) -> None:
+    """ Create a completed test job with the given number of test tasks and their logs. """
+    generator = random.Random(seed)
+    start = datetime(2017, 7, 1, tzinfo=timezone.utc)
+
+    batch.jobs[run_id] = SimpleNamespace(id=run_id, state=JobState.completed, metadata=[], creation_time=start,
+                                         display_name='Automation on build build-fake. Live: False',
+                                         pool_info=SimpleNamespace(pool_id='test-pool'),
+                                         common_environment_settings=[], job_preparation_task=None)
+    job_tasks = batch.tasks.setdefault(run_id, {})
+    container = storage.containers.setdefault(f'output-{run_id}', {})
+
+    for index in range(tasks):
+        module = MODULES[index % len(MODULES)]
+        task_id = f'test-{index:06}'
+        begin = start + timedelta(seconds=generator.uniform(0, 3600))
+        end = begin + timedelta(seconds=generator.expovariate(1 / 20))
+        exit_code = 1 if generator.random() < failure_rate else 0
+
+        job_tasks[task_id] = SimpleNamespace(
+            id=task_id,
+            display_name=f'{index} test_{module}_{index} (azure.cli.command_modules.{module}.tests.test_{module}'
+                         f'.{module.capitalize()}ScenarioTest)',
+            command_line=f'/bin/bash -c "python -m unittest test_{index}"',
+            state=TaskState.completed, state_transition_time=end, creation_time=start,
+            execution_info=SimpleNamespace(exit_code=exit_code, start_time=begin, end_time=end, retry_count=0,
+                                          result='failure' if exit_code else 'success'),
+            node_info=SimpleNamespace(node_id=f'node-{index % 10}', pool_id='test-pool'),
+            environment_settings=None, resource_files=None, output_files=None, constraints=None, user_identity=None)
+        container[f'{task_id}/stdout.txt'] = lambda task_id=task_id: _generate_log(task_id, log_lines)
+
+
+def populate_build(storage: FakeBlobService, build_id: str, blobs: int = 5000) -> None:
+    """ Create a build made of the given number of artifact blobs in the builds container. """
+    container = storage.containers.setdefault('builds', {})
+    for index in range(blobs):
+        container[f'{build_id}/app/packages/package_{index:05}.whl'] = 'wheel'
+    container[f'{build_id}/app/install.sh'] = '#!/bin/bash'
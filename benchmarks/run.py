@@ -0,0 +1,169 @@
+"""
+Scale benchmarks of Miriam against the in-process fakes of the Batch and Blob services.
+
+Every benchmark runs a Miriam code path on a synthetic run of --tasks test tasks and a build of --blobs artifacts, and
+reports its best and median wall time along with the service calls it made. With --save the results are written to a
+JSON file. With --baseline the results are compared to such a file and the run fails if a benchmark got slower than
+the tolerance allows, so that performance regressions are caught offline.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=wrong-import-position
+import yaml
+import fake_azure
+from miriam._utility import set_clients
+
+RUN_ID = 'test-bench'
+BUILD_ID = 'build-bench'
+
+
+class Environment(object):
+    """ The fake services, the settings file and a scratch directory shared by the benchmarks. """
+
+    def __init__(self, args: argparse.Namespace):
+        self.batch = fake_azure.FakeBatchService(latency=args.latency_ms / 1000)
+        self.storage = fake_azure.FakeBlobService(latency=args.latency_ms / 1000)
+        fake_azure.populate_test_run(self.batch, self.storage, RUN_ID, tasks=args.tasks, log_lines=args.log_lines)
+        fake_azure.populate_build(self.storage, BUILD_ID, blobs=args.blobs)
+
+        self.settings = fake_azure.FAKE_SETTINGS
+        set_clients(self.settings, self.batch, self.storage, self.storage.session)
+
+        self.directory = tempfile.mkdtemp(prefix='miriam-bench-')
+        self.config_path = os.path.join(self.directory, 'config.yaml')
+        with open(self.config_path, 'w') as config_file:
+            yaml.safe_dump(self.settings, config_file, default_flow_style=False)
+
+    def calls(self) -> Counter:
+        return self.batch.calls + self.storage.calls
+
+    def parse_command(self, module, argv: list) -> argparse.Namespace:
+        """ Parse the arguments of a sub command with its own parser so that the defaults stay in sync. """
+        parser = argparse.ArgumentParser()
+        module.setup(parser.add_subparsers())
+        args = parser.parse_args(argv)
+        args.config = open(self.config_path, 'r')
+        args.verbose = 0
+        return args
+
+
+def _report(*options):
+    def _benchmark(env: Environment):
+        import miriam.report
+        args = env.parse_command(miriam.report, ['report', RUN_ID] + list(options))
+        with contextlib.redirect_stdout(io.StringIO()):
+            args.func(args)
+    return _benchmark
+
+
+def _report_cached(warm: bool):
+    def _benchmark(env: Environment):
+        cache_path = os.path.join(env.directory, 'cache.db')
+        if not warm and os.path.exists(cache_path):
+            os.remove(cache_path)
+        _report('--cache', cache_path)(env)
+    return _benchmark
+
+
+def _list_build_resource_files(env: Environment):
+    from miriam.schedule_test import _list_build_resource_files as list_files
+    list_files(env.storage, BUILD_ID)
+
+
+def _create_test_job(env: Environment):
+    from miriam.schedule_test import create_test_job
+    create_test_job(BUILD_ID, env.settings)
+
+
+BENCHMARKS = [
+    ('report', _report('--no-cache')),
+    ('report-failed', _report('--no-cache', '--failed')),
+    ('report-cache-cold', _report_cached(warm=False)),
+    ('report-cache-warm', _report_cached(warm=True)),
+    ('report-html', _report('--no-cache', '--html')),
+    ('report-html-logs', _report('--no-cache', '--html', '--include-log')),
+    ('report-html-log-files', _report('--no-cache', '--html', '--include-log', '--log-files')),
+    ('list-build-resource-files', _list_build_resource_files),
+    ('create-test-job', _create_test_job),
+]
+
+
+def _run(env: Environment, benchmark, repeat: int) -> dict:
+    timings = []
+    calls = Counter()
+    for _ in range(repeat):
+        before = env.calls()
+        start = time.perf_counter()
+        benchmark(env)
+        timings.append(time.perf_counter() - start)
+        calls = env.calls() - before
+    return {'best': min(timings), 'median': statistics.median(timings), 'calls': sum(calls.values())}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--tasks', type=int, default=20000, help='The number of test tasks. Default: 20000')
+    parser.add_argument('--blobs', type=int, default=5000, help='The number of build artifact blobs. Default: 5000')
+    parser.add_argument('--log-lines', type=int, default=200, help='The number of lines per test log. Default: 200')
+    parser.add_argument('--latency-ms', type=float, default=0, help='The latency of every service call. Default: 0')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of runs of each benchmark. Default: 3')
+    parser.add_argument('--only', nargs='+', choices=[name for name, _ in BENCHMARKS], help='The benchmarks to run.')
+    parser.add_argument('--save', metavar='PATH', help='Save the results to a JSON file.')
+    parser.add_argument('--baseline', metavar='PATH', help='Compare the results to the ones saved in a JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='The slowdown against the baseline tolerated before failing. Default: 0.25')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+    save_path = os.path.abspath(args.save) if args.save else None
+
+    env = Environment(args)
+    os.chdir(env.directory)
+
+    results = {}
+    regressions = []
+    print(f'{args.tasks} tasks, {args.blobs} blobs, {args.latency_ms} ms latency, best of {args.repeat}')
+    print('{:<28} {:>10} {:>10} {:>8} {:>10}'.format('benchmark', 'best (s)', 'median (s)', 'calls', 'baseline'))
+    for name, benchmark in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        result = results[name] = _run(env, benchmark, args.repeat)
+
+        comparison = ''
+        if name in baseline:
+            ratio = result['best'] / baseline[name]['best']
+            comparison = f'{ratio:.2f}x'
+            if ratio > 1 + args.tolerance:
+                regressions.append(name)
+        print('{:<28} {:>10.3f} {:>10.3f} {:>8} {:>10}'.format(name, result['best'], result['median'],
+                                                              result['calls'], comparison))
+
+    if save_path:
+        with open(save_path, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
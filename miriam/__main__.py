@@ -1,15 +1,40 @@
+# The sub commands and the modules defining them. Only the module of the invoked command is imported, so the help and
+# the light commands don't pay for importing the Azure SDK.
+COMMANDS = [
+    ('build', 'miriam.schedule_build', 'Start a build job'),
+    ('test', 'miriam.schedule_test', 'Start a test job'),
+    ('report', 'miriam.report', 'Report the results of a test job.'),
+    ('compare', 'miriam.compare', 'Compare the test results and durations of two test jobs.'),
+    ('timing', 'miriam.timing', 'Break down the wall time of a test job by phase.'),
+    ('submit-tasks', 'miriam.submit', 'Add the test tasks to a test job in bulk.'),
+    ('export', 'miriam.export', 'Export the results of a test job to a database or a file.'),
+    ('plan-pool', 'miriam.plan_pool', 'Predict the run time and cost of pool sizes from a test job.'),
+    ('rerun', 'miriam.rerun', 'Run the failed tests of a test job again.'),
+    ('watch', 'miriam.watch', 'Follow the progress of a test job until it is completed.'),
+    ('create-default', 'miriam.create_default_config', 'Create a default config file as template.'),
+    ('create-pools', 'miriam.create_pools', 'Create the batch pools.'),
+    ('pools', 'miriam.create_pools', 'Manage the existing batch pools.'),
+    ('verify-settings', 'miriam.verify_settings', 'Verify the settings file.'),
+]
+
+
+def _find_command(argv: list) -> str:
+    """ Returns the sub command in the arguments, skipping the global options. """
+    arguments = iter(argv)
+    for argument in arguments:
+        if argument == '-c':
+            next(arguments, None)
+        elif not argument.startswith('-'):
+            return argument
+    return None
+
+
 def program():
     import argparse
+    import importlib
     import sys
     import os.path
 
-    import miriam.schedule_build
-    import miriam.schedule_test
-    import miriam.create_default_config
-    import miriam.verify_settings
-    import miriam.create_pools
-    import miriam.report
-
     from miriam._utility import config_logging
 
     default_user_config = os.path.expanduser('~/.miriam/config.yaml')
@@ -22,12 +47,13 @@ def program():
 
     subparsers = parser.add_subparsers(help='Sub Commands')
 
-    miriam.schedule_build.setup(subparsers)
-    miriam.schedule_test.setup(subparsers)
-    miriam.report.setup(subparsers)
-    miriam.create_default_config.setup(subparsers)
-    miriam.create_pools.setup(subparsers)
-    miriam.verify_settings.setup(subparsers)
+    command = _find_command(sys.argv[1:])
+    command_module = next((module for name, module, _ in COMMANDS if name == command), None)
+    for name, module, command_help in COMMANDS:
+        if module != command_module:
+            subparsers.add_parser(name, help=command_help)
+    if command_module:
+        importlib.import_module(command_module).setup(subparsers)
 
     args = parser.parse_args()
 
@@ -1,6 +1,13 @@
+import threading
 from argparse import Namespace
-from azure.storage.blob import BlockBlobService
-from azure.batch import BatchServiceClient
+from collections import namedtuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from datetime import timedelta
+    import requests
+    from azure.storage.blob import BlockBlobService
+    from azure.batch import BatchServiceClient
 
 
 def config_logging(args: Namespace):
@@ -18,11 +25,153 @@ def get_command_string(*args):
     return "/bin/bash -c 'set -e; set -o pipefail; {}; wait'".format(';'.join(args))
 
 
-def create_batch_client(settings: dict) -> BatchServiceClient:
-    from azure.batch.batch_auth import SharedKeyCredentials
-    cred = SharedKeyCredentials(settings['azurebatch']['account'], settings['azurebatch']['key'])
-    return BatchServiceClient(cred, settings['azurebatch']['endpoint'])
+# Per process cache of the parsed settings, the authenticated clients, the HTTP session and the SAS tokens. The clients
+# are keyed by the account settings so that all the commands and threads of a process share them.
+_CACHE_LOCK = threading.RLock()
+_CACHE = {}
+
+# A cached SAS token is renewed once less than a quarter of its lifetime is left.
+_SAS_RENEWAL_RATIO = 0.25
+
+
+def _get_cached(key: tuple, factory):
+    with _CACHE_LOCK:
+        if key not in _CACHE:
+            _CACHE[key] = factory()
+        return _CACHE[key]
+
+
+def load_settings(config_file) -> dict:
+    """ Parse the settings file. A file is parsed only once per process. """
+    import yaml
+    return _get_cached(('settings', getattr(config_file, 'name', id(config_file))), lambda: yaml.load(config_file))
+
+
+def get_http_session(pool_size: int = 10) -> 'requests.Session':
+    """
+    Returns the HTTP session shared by the process. Its connections are kept alive and pooled. The pool grows to the
+    largest pool size requested so far.
+    """
+    import requests
+
+    def _create_session():
+        return {'session': requests.Session(), 'pool_size': 0}
+
+    entry = _get_cached(('http',), _create_session)
+    with _CACHE_LOCK:
+        if entry['pool_size'] < pool_size:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=pool_size)
+            entry['session'].mount('https://', adapter)
+            entry['session'].mount('http://', adapter)
+            entry['pool_size'] = pool_size
+    return entry['session']
+
+
+def _get_batch_key(settings: dict) -> tuple:
+    return 'batch', settings['azurebatch']['account'], settings['azurebatch']['key'], settings['azurebatch']['endpoint']
+
+
+def _get_storage_key(settings: dict) -> tuple:
+    return 'storage', settings['azurestorage']['account'], settings['azurestorage']['key']
+
+
+def set_clients(settings: dict, batch_client=None, storage_client=None, http_session=None) -> None:
+    """
+    Install the clients used for the accounts of the given settings instead of creating them, for example the local
+    stand-ins of the services used by the benchmarks.
+    """
+    with _CACHE_LOCK:
+        if batch_client:
+            _CACHE[_get_batch_key(settings)] = batch_client
+        if storage_client:
+            _CACHE[_get_storage_key(settings)] = storage_client
+        if http_session:
+            _CACHE[('http',)] = {'session': http_session, 'pool_size': float('inf')}
+
+
+def create_batch_client(settings: dict) -> 'BatchServiceClient':
+    """ Returns the Batch client of the account. The client is created once per process and keeps its connections. """
+    def _create_client():
+        from azure.batch import BatchServiceClient
+        from azure.batch.batch_auth import SharedKeyCredentials
+        cred = SharedKeyCredentials(settings['azurebatch']['account'], settings['azurebatch']['key'])
+        client = BatchServiceClient(cred, settings['azurebatch']['endpoint'])
+        client.config.keep_alive = True
+        return client
+
+    return _get_cached(_get_batch_key(settings), _create_client)
+
+
+def create_storage_client(settings: dict) -> 'BlockBlobService':
+    """ Returns the storage client of the account. The client is created once per process on the shared session. """
+    def _create_client():
+        from azure.storage.blob import BlockBlobService
+        return BlockBlobService(settings['azurestorage']['account'], settings['azurestorage']['key'],
+                                request_session=get_http_session())
+
+    return _get_cached(_get_storage_key(settings), _create_client)
+
+
+def _get_sas(key: tuple, lifetime: 'timedelta', generate) -> str:
+    from datetime import datetime
+
+    now = datetime.utcnow()
+    with _CACHE_LOCK:
+        token, expiry = _CACHE.get(key, (None, now))
+        if (expiry - now) < lifetime * _SAS_RENEWAL_RATIO:
+            expiry = now + lifetime
+            token = generate(expiry)
+            _CACHE[key] = token, expiry
+    return token
+
+
+def get_container_sas(storage_client: 'BlockBlobService', container_name: str, permission,
+                      lifetime: 'timedelta' = None, protocol: str = None) -> str:
+    """ Returns a container SAS token. The token is reused until less than a quarter of its lifetime is left. """
+    from datetime import timedelta
+
+    lifetime = lifetime or timedelta(days=1)
+    return _get_sas(('container-sas', storage_client.account_name, container_name, str(permission), protocol),
+                    lifetime,
+                    lambda expiry: storage_client.generate_container_shared_access_signature(
+                        container_name, permission=permission, expiry=expiry, protocol=protocol))
+
+
+def get_blob_sas(storage_client: 'BlockBlobService', container_name: str, blob_name: str, permission,
+                 lifetime: 'timedelta' = None) -> str:
+    """ Returns a blob SAS token. The token is reused until less than a quarter of its lifetime is left. """
+    from datetime import timedelta
+
+    lifetime = lifetime or timedelta(days=1)
+    return _get_sas(('blob-sas', storage_client.account_name, container_name, blob_name, str(permission)),
+                    lifetime,
+                    lambda expiry: storage_client.generate_blob_shared_access_signature(
+                        container_name, blob_name, permission=permission, expiry=expiry))
+
+
+class TestName(namedtuple('TestName', ['module', 'method', 'test_class'])):
+    @property
+    def full_name(self) -> str:
+        return f'{self.test_class}.{self.method}'
+
+
+def parse_test_name(display_name: str) -> TestName:
+    """ Parse the display name of a test task, which is in the form of '<prefix> <test method> (<test class>)'. """
+    _, test_method, test_class = display_name.split(' ')
+    test_class = test_class.strip('()')
+
+    module = get_test_module(test_class)
+    if not module:
+        raise ValueError('Unexpected test display name: {}'.format(display_name))
+
+    return TestName(module, test_method, test_class)
 
 
-def create_storage_client(settings: dict) -> BlockBlobService:
-    return BlockBlobService(settings['azurestorage']['account'], settings['azurestorage']['key'])
+def get_test_module(test_class: str) -> str:
+    """ The module of a test class, or of the full name of a test, or None if it isn't an Azure CLI test. """
+    parts = test_class.split('.')
+    if test_class.startswith('azure.cli.command_modules.'):
+        return parts[3].upper()
+    if test_class.startswith('azure.cli.'):
+        return parts[2].upper()
+    return None
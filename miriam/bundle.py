@@ -0,0 +1,110 @@
+"""
+A bundle runs many short tests in one Batch task to amortize the per-task overhead.
+
+The bundle task reads its tests, one '<display name>\t<command line>' per line, from the MIRIAM_BUNDLE_TESTS environment
+variable and runs them one after another in the task working directory. The output of the n-th test is saved to
+n/stdout.txt and its result is appended to results.tsv as '<display name>\t<exit code>\t<start>\t<end>', the times
+being seconds since epoch. Both are uploaded to the output container under the bundle task id so that the report
+expands a bundle back into per-test results and logs.
+"""
+
+from miriam.cache import TaskRecord, ExecutionRecord
+
+BUNDLE_PREFIX = 'bundle-'
+BUNDLE_TESTS_SETTING = 'MIRIAM_BUNDLE_TESTS'
+
+_BUNDLE_SCRIPT = r"""failed=0; index=0; : > results.tsv
+while IFS=$'\t' read -r name command; do
+  [ -n "$command" ] || continue
+  mkdir -p $index
+  start=$(date +%s.%N)
+  bash -c "$command" > $index/stdout.txt 2>&1 < /dev/null; code=$?
+  printf '%s\t%s\t%s\t%s\n' "$name" $code $start $(date +%s.%N) >> results.tsv
+  [ $code -eq 0 ] || failed=1
+  index=$((index + 1))
+done <<< "$MIRIAM_BUNDLE_TESTS"
+exit $failed"""
+
+
+def is_bundle(task_id: str) -> bool:
+    return task_id.startswith(BUNDLE_PREFIX)
+
+
+def get_bundle_id(index: int, shard: int = 0) -> str:
+    """ The id of a bundle of a test plan. The bundles of the other shards than the first one hold the shard index. """
+    return f'{BUNDLE_PREFIX}{index:04}' if not shard else f'{BUNDLE_PREFIX}shard{shard}-{index:04}'
+
+
+def create_bundle_task(bundle_id: str, tests: list, output_container_url: str):
+    """
+    Create the task running the given (display name, command line) tests. The results and the logs are uploaded to
+    the output container once the task completes, whether the tests pass or not.
+    """
+    import shlex
+    from azure.batch.models import (TaskAddParameter, EnvironmentSetting, OutputFile, OutputFileDestination,
+                                    OutputFileUploadOptions, OutputFileUploadCondition,
+                                    OutputFileBlobContainerDestination)
+
+    def _output_file(pattern: str, path: str) -> OutputFile:
+        return OutputFile(pattern,
+                          OutputFileDestination(OutputFileBlobContainerDestination(output_container_url, path)),
+                          OutputFileUploadOptions(OutputFileUploadCondition.task_completion))
+
+    return TaskAddParameter(id=bundle_id,
+                            display_name=f'{bundle_id} ({len(tests)} tests)',
+                            command_line='/bin/bash -c {}'.format(shlex.quote(_BUNDLE_SCRIPT)),
+                            environment_settings=[EnvironmentSetting(
+                                name=BUNDLE_TESTS_SETTING,
+                                value='\n'.join(f'{name}\t{command}' for name, command in tests))],
+                            output_files=[_output_file('results.tsv', f'{bundle_id}/results.tsv'),
+                                          _output_file('*/stdout.txt', bundle_id)])
+
+
+def parse_bundle_tests(task) -> list:
+    """ Returns the (display name, command line) tests run by the given bundle task. """
+    value = next(setting.value for setting in task.environment_settings if setting.name == BUNDLE_TESTS_SETTING)
+    return [tuple(line.split('\t', 1)) for line in value.split('\n') if '\t' in line]
+
+
+def parse_bundle_results(bundle_id: str, text: str):
+    """ Turn the results.tsv of a bundle into one task record per test. """
+    from datetime import datetime
+
+    for index, line in enumerate(l for l in text.split('\n') if l.strip()):
+        display_name, exit_code, start, end = line.split('\t')
+        yield TaskRecord(f'{bundle_id}/{index}', display_name, 'completed',
+                         ExecutionRecord(int(exit_code),
+                                         datetime.utcfromtimestamp(float(start)),
+                                         datetime.utcfromtimestamp(float(end))))
+
+
+def expand_bundles(tasks, run_id: str, settings: dict, failed_only: bool = False):
+    """
+    Replace the completed bundle tasks by the results of their tests. Bundles not completed yet are left out since
+    their results are not known. Other tasks pass through.
+    """
+    from azure.common import AzureHttpError
+    from miriam._utility import create_storage_client, get_logger
+
+    logger = get_logger('bundle')
+    storage = None
+
+    for task in tasks:
+        if not is_bundle(task.id):
+            yield task
+            continue
+        if getattr(task.state, 'value', task.state) != 'completed':
+            logger.info('Bundle %s is not completed yet.', task.id)
+            continue
+
+        storage = storage or create_storage_client(settings)
+        try:
+            text = storage.get_blob_to_text(f'output-{run_id}', f'{task.id}/results.tsv').content
+        except AzureHttpError as ex:
+            logger.warning('Failed to retrieve the results of bundle %s: %s', task.id, ex)
+            continue
+
+        for record in parse_bundle_results(task.id, text):
+            if failed_only and record.execution_info.exit_code == 0:
+                continue
+            yield record
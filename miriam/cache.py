@@ -0,0 +1,208 @@
+import os.path
+import sqlite3
+from collections import namedtuple
+from datetime import datetime, timezone
+
+DEFAULT_CACHE_PATH = os.path.expanduser('~/.miriam/cache.db')
+
+# Light weight stand-ins of CloudTask and TaskExecutionInformation carrying only what the report reads.
+TaskRecord = namedtuple('TaskRecord', ['id', 'display_name', 'state', 'execution_info'])
+ExecutionRecord = namedtuple('ExecutionRecord', ['exit_code', 'start_time', 'end_time'])
+RunRecord = namedtuple('RunRecord', ['run_id', 'watermark', 'completed', 'jobs'])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    watermark REAL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    jobs TEXT
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    run_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    display_name TEXT,
+    state TEXT,
+    exit_code INTEGER,
+    start_time REAL,
+    end_time REAL,
+    PRIMARY KEY (run_id, task_id)
+);
+CREATE TABLE IF NOT EXISTS logs (
+    run_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    tail_kb INTEGER NOT NULL,
+    content TEXT,
+    PRIMARY KEY (run_id, task_id, tail_kb)
+);
+CREATE TABLE IF NOT EXISTS durations (
+    test TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    recorded REAL NOT NULL,
+    PRIMARY KEY (test, run_id)
+);
+"""
+
+
+def to_utc(value: datetime) -> datetime:
+    """ Convert a timezone aware datetime, as returned by the Batch service, to a naive UTC datetime. """
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _to_timestamp(value: datetime):
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return (value - datetime(1970, 1, 1)).total_seconds()
+    return value.timestamp()
+
+
+def _from_timestamp(value: float):
+    return datetime.utcfromtimestamp(value) if value is not None else None
+
+
+def _state_name(state) -> str:
+    return getattr(state, 'value', state)
+
+
+def open_cache(path: str = None) -> sqlite3.Connection:
+    path = path or DEFAULT_CACHE_PATH
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    conn = sqlite3.connect(path)
+    conn.executescript(_SCHEMA)
+    if 'jobs' not in set(column[1] for column in conn.execute('PRAGMA table_info(runs)')):
+        # a cache created before the other jobs of the runs were recorded
+        with conn:
+            conn.execute('ALTER TABLE runs ADD COLUMN jobs TEXT')
+    return conn
+
+
+def get_run(conn: sqlite3.Connection, run_id: str) -> RunRecord:
+    """ The cached state of a run. Its jobs are the ids of its shards and reruns, or None if they are not recorded. """
+    row = conn.execute('SELECT run_id, watermark, completed, jobs FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+    if not row:
+        return None
+    jobs = None if row[3] is None else [job_id for job_id in row[3].split(',') if job_id]
+    return RunRecord(row[0], _from_timestamp(row[1]), bool(row[2]), jobs)
+
+
+def _update_run(conn: sqlite3.Connection, run_id: str, columns: dict) -> None:
+    names = sorted(columns)
+    values = [columns[name] for name in names] + [run_id]
+    with conn:
+        cursor = conn.execute('UPDATE runs SET {} WHERE run_id = ?'.format(', '.join(f'{name} = ?' for name in names)),
+                              values)
+        if not cursor.rowcount:
+            conn.execute('INSERT INTO runs ({}, run_id) VALUES ({}?)'.format(', '.join(names), '?, ' * len(names)),
+                         values)
+
+
+def save_run(conn: sqlite3.Connection, run_id: str, watermark: datetime, completed: bool) -> None:
+    _update_run(conn, run_id, {'watermark': _to_timestamp(watermark), 'completed': int(completed)})
+
+
+def save_run_jobs(conn: sqlite3.Connection, run_id: str, job_ids: list) -> None:
+    """ Record the ids of the shards and reruns of a run. """
+    _update_run(conn, run_id, {'jobs': ','.join(job_ids)})
+
+
+def save_tasks(conn: sqlite3.Connection, run_id: str, tasks) -> int:
+    """
+    Insert or update the given tasks. A task keeps its original position when it is updated so that the cached
+    results are listed in the same order as the service listed them. Returns the number of tasks saved.
+    """
+    count = 0
+    with conn:
+        for task in tasks:
+            info = task.execution_info
+            values = (task.display_name,
+                      _state_name(task.state),
+                      info.exit_code if info else None,
+                      _to_timestamp(info.start_time) if info else None,
+                      _to_timestamp(info.end_time) if info else None,
+                      run_id,
+                      task.id)
+            cursor = conn.execute('UPDATE tasks SET display_name = ?, state = ?, exit_code = ?, start_time = ?, '
+                                  'end_time = ? WHERE run_id = ? AND task_id = ?', values)
+            if not cursor.rowcount:
+                conn.execute('INSERT INTO tasks (display_name, state, exit_code, start_time, end_time, run_id, '
+                             'task_id) VALUES (?, ?, ?, ?, ?, ?, ?)', values)
+            count += 1
+    return count
+
+
+def delete_tasks(conn: sqlite3.Connection, run_id: str, task_ids: list) -> None:
+    with conn:
+        conn.executemany('DELETE FROM tasks WHERE run_id = ? AND task_id = ?',
+                         ((run_id, task_id) for task_id in task_ids))
+
+
+def count_incomplete_tasks(conn: sqlite3.Connection, run_id: str) -> int:
+    return conn.execute("SELECT COUNT(*) FROM tasks WHERE run_id = ? AND state != 'completed'", (run_id,)).fetchone()[0]
+
+
+def list_tasks(conn: sqlite3.Connection, run_id: str, failed_only: bool = False, state: str = None):
+    query = 'SELECT task_id, display_name, state, exit_code, start_time, end_time FROM tasks WHERE run_id = ?'
+    params = [run_id]
+    if failed_only:
+        query += " AND (exit_code != 0 OR state = 'completed' AND exit_code IS NULL)"
+    if state:
+        query += ' AND state = ?'
+        params.append(state)
+    query += ' ORDER BY rowid'
+
+    for task_id, display_name, task_state, exit_code, start_time, end_time in conn.execute(query, params):
+        info = ExecutionRecord(exit_code, _from_timestamp(start_time), _from_timestamp(end_time)) \
+            if start_time is not None else None
+        yield TaskRecord(task_id, display_name, task_state, info)
+
+
+def list_log_ids(conn: sqlite3.Connection, run_id: str, tail_kb: int) -> set:
+    rows = conn.execute('SELECT task_id FROM logs WHERE run_id = ? AND tail_kb = ?', (run_id, tail_kb))
+    return set(task_id for task_id, in rows)
+
+
+def get_log(conn: sqlite3.Connection, run_id: str, task_id: str, tail_kb: int) -> str:
+    row = conn.execute('SELECT content FROM logs WHERE run_id = ? AND task_id = ? AND tail_kb = ?',
+                       (run_id, task_id, tail_kb)).fetchone()
+    return row[0] if row else None
+
+
+def save_logs(conn: sqlite3.Connection, run_id: str, tail_kb: int, logs: dict) -> None:
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO logs (run_id, task_id, tail_kb, content) VALUES (?, ?, ?, ?)',
+                         ((run_id, task_id, tail_kb, content) for task_id, content in logs.items()))
+
+
+def save_durations(conn: sqlite3.Connection, run_id: str, durations) -> None:
+    """ Record the (test, seconds) pairs measured in the given run. """
+    import time
+
+    now = time.time()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO durations (test, run_id, seconds, recorded) VALUES (?, ?, ?, ?)',
+                         ((test, run_id, seconds, now) for test, seconds in durations))
+
+
+def list_durations(conn: sqlite3.Connection, history: int = 5) -> dict:
+    """ Returns the most recent durations of each test, up to history records per test, the latest first. """
+    results = {}
+    for test, seconds in conn.execute('SELECT test, seconds FROM durations ORDER BY recorded DESC'):
+        samples = results.setdefault(test, [])
+        if len(samples) < history:
+            samples.append(seconds)
+    return results
+
+
+def count_tasks(conn: sqlite3.Connection, run_id: str) -> dict:
+    """ Count the cached tasks of a run by their outcome: passed, failed, running and queued. """
+    row = conn.execute("SELECT "
+                       "TOTAL(state = 'completed' AND exit_code = 0), "
+                       "TOTAL(state = 'completed' AND (exit_code IS NULL OR exit_code != 0)), "
+                       "TOTAL(state = 'running'), "
+                       "TOTAL(state IN ('active', 'preparing')) "
+                       "FROM tasks WHERE run_id = ?", (run_id,)).fetchone()
+    return dict(zip(('passed', 'failed', 'running', 'queued'), (int(value) for value in row)))
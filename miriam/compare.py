@@ -0,0 +1,130 @@
+import argparse
+from collections import namedtuple
+
+# The outcome of a test in the two runs. The durations and the exit codes are None when the test didn't run.
+Comparison = namedtuple('Comparison', ['test', 'module', 'baseline_exit', 'candidate_exit', 'baseline_seconds',
+                                       'candidate_seconds'])
+
+
+def _iter_outcomes(tasks):
+    """ Yield the (test name, module, exit code, duration) of the completed tests. """
+    from miriam._utility import parse_test_name
+
+    for task in tasks:
+        info = task.execution_info
+        if not info or info.end_time is None:
+            continue
+        try:
+            test_name = parse_test_name(task.display_name)
+        except ValueError:
+            continue
+        yield (test_name.full_name, test_name.module, info.exit_code,
+               (info.end_time - info.start_time).total_seconds())
+
+
+def join_runs(baseline_tasks, candidate_tasks):
+    """
+    Join the tests of two runs by name. Only the baseline is held in memory while the candidate is streamed through.
+    Tests found in one run only are yielded with None for the other run.
+    """
+    baseline = dict((test, (module, exit_code, seconds))
+                    for test, module, exit_code, seconds in _iter_outcomes(baseline_tasks))
+
+    for test, module, exit_code, seconds in _iter_outcomes(candidate_tasks):
+        _, baseline_exit, baseline_seconds = baseline.pop(test, (None, None, None))
+        yield Comparison(test, module, baseline_exit, exit_code, baseline_seconds, seconds)
+
+    for test, (module, exit_code, seconds) in baseline.items():
+        yield Comparison(test, module, exit_code, None, seconds, None)
+
+
+def is_regression(comparison: Comparison, ratio: float, seconds: float) -> bool:
+    """ A test regresses if it is both ratio times and seconds slower than in the baseline. """
+    if comparison.baseline_seconds is None or comparison.candidate_seconds is None:
+        return False
+    return comparison.candidate_seconds > comparison.baseline_seconds * ratio and \
+        comparison.candidate_seconds - comparison.baseline_seconds >= seconds
+
+
+def compare_runs(comparisons, ratio: float = 1.5, seconds: float = 10) -> dict:
+    """
+    Summarize the comparisons. Returns the duration regressions, the newly failing and the fixed tests, and the totals
+    of every module as [tests, baseline seconds, candidate seconds, regressions, new failures]. The seconds are summed
+    over the tests found in both runs so that added and removed tests don't count as changes of duration.
+    """
+    regressions = []
+    failing = []
+    fixed = []
+    modules = {}
+
+    for comparison in comparisons:
+        totals = modules.setdefault(comparison.module, [0, 0.0, 0.0, 0, 0])
+        totals[0] += 1
+        if comparison.baseline_seconds is not None and comparison.candidate_seconds is not None:
+            totals[1] += comparison.baseline_seconds
+            totals[2] += comparison.candidate_seconds
+
+        if is_regression(comparison, ratio, seconds):
+            regressions.append(comparison)
+            totals[3] += 1
+        if comparison.baseline_exit == 0 and comparison.candidate_exit not in (0, None):
+            failing.append(comparison)
+            totals[4] += 1
+        elif comparison.baseline_exit not in (0, None) and comparison.candidate_exit == 0:
+            fixed.append(comparison)
+
+    regressions.sort(key=lambda c: c.baseline_seconds - c.candidate_seconds)
+    return {'regressions': regressions, 'failing': failing, 'fixed': fixed, 'modules': modules}
+
+
+def _compare(args: argparse.Namespace) -> None:
+    import sys
+    import tabulate
+    from miriam._utility import load_settings
+    from miriam.cache import open_cache
+    from miriam.report import load_results
+
+    settings = load_settings(args.config)
+    cache = None if args.no_cache else open_cache(args.cache)
+
+    summary = compare_runs(join_runs(load_results(settings, args.baseline_run, cache),
+                                     load_results(settings, args.candidate_run, cache)),
+                           args.ratio, args.seconds)
+
+    modules = sorted(summary['modules'].items(), key=lambda item: item[1][1] - item[1][2])
+    print(tabulate.tabulate([[module, tests, baseline, candidate, candidate - baseline, regressions, failing]
+                             for module, (tests, baseline, candidate, regressions, failing) in modules],
+                            headers=['Module', 'Tests', 'Baseline (s)', 'Candidate (s)', 'Delta (s)', 'Regressions',
+                                     'New Failures'], floatfmt='.1f'))
+
+    if summary['regressions']:
+        print(f'\n{len(summary["regressions"])} tests are slower:')
+        print(tabulate.tabulate([[c.module, c.test, c.baseline_seconds, c.candidate_seconds,
+                                  c.candidate_seconds - c.baseline_seconds]
+                                 for c in summary['regressions'][:args.top]],
+                                headers=['Module', 'Test', 'Baseline (s)', 'Candidate (s)', 'Delta (s)'],
+                                floatfmt='.1f'))
+    for title, key in (('fail now', 'failing'), ('are fixed', 'fixed')):
+        if summary[key]:
+            print(f'\n{len(summary[key])} tests {title}:')
+            print('\n'.join(f'  {c.module} {c.test}' for c in summary[key]))
+
+    sys.exit(1 if summary['regressions'] or summary['failing'] else 0)
+
+
+def setup(subparsers) -> None:
+    from miriam.cache import DEFAULT_CACHE_PATH
+
+    parser = subparsers.add_parser('compare', help='Compare the test results and durations of two test jobs.')
+    parser.add_argument('baseline_run', help='The test run id to compare to.')
+    parser.add_argument('candidate_run', help='The test run id to compare.')
+    parser.add_argument('--ratio', type=float, default=1.5,
+                        help='A test regresses if it is this many times slower than in the baseline. Default: 1.5')
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='A test regresses only if it is at least this many seconds slower. Default: 10')
+    parser.add_argument('--top', type=int, default=20, help='The number of slowed down tests listed. Default: 20')
+    parser.add_argument('--cache', metavar='PATH',
+                        help=f'The path of the local results cache. Default: {DEFAULT_CACHE_PATH}')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Query the Batch service for all the results and skip the local results cache.')
+    parser.set_defaults(func=_compare)
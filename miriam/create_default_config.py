@@ -45,5 +45,5 @@ def setup(subparsers) -> None:
     parser = subparsers.add_parser('create-default', help='Create a default config file as template.')
     parser.add_argument('--output', help='The path where the default config file is saved.',
                         type=argparse.FileType('w'),
-                        default=open(os.path.join(os.getcwd(), 'default-config.yaml'), 'w'))
+                        default=os.path.join(os.getcwd(), 'default-config.yaml'))
     parser.set_defaults(func=_create_default_config)
@@ -1,5 +1,65 @@
 import argparse
 
+# The bounds of the autoscale evaluation interval accepted by the Batch service, in minutes.
+MIN_AUTOSCALE_INTERVAL = 5
+MAX_AUTOSCALE_INTERVAL = 168 * 60
+
+
+def get_autoscale_formula(pool_setting: dict) -> str:
+    """
+    Generate the autoscale formula of a pool. The number of nodes follows the pending (active and running) tasks
+    divided by the max tasks per node, bounded by the min and max of the autoscale setting. If low-pri is set, the
+    min nodes are dedicated and the nodes above them are low-priority.
+    """
+    autoscale = pool_setting['autoscale']
+    minimum = int(autoscale.get('min', 0))
+    maximum = int(autoscale['max'])
+    max_tasks = int(pool_setting['max-tasks'])
+
+    formula = [
+        '$samples = $PendingTasks.GetSamplePercent(TimeInterval_Minute * 5);',
+        '$tasks = $samples < 70 ? max(0, $PendingTasks.GetSample(1)) : '
+        'max($PendingTasks.GetSample(1), avg($PendingTasks.GetSample(TimeInterval_Minute * 5)));',
+        f'$nodes = min({maximum}, max({minimum}, ceil($tasks / {max_tasks})));'
+    ]
+    if autoscale.get('low-pri', False):
+        formula.append(f'$TargetDedicatedNodes = {minimum};')
+        formula.append(f'$TargetLowPriorityNodes = $nodes - {minimum};')
+    else:
+        formula.append('$TargetDedicatedNodes = $nodes;')
+        formula.append('$TargetLowPriorityNodes = 0;')
+    formula.append('$NodeDeallocationOption = taskcompletion;')
+
+    return '\n'.join(formula)
+
+
+def get_autoscale_interval(pool_setting: dict):
+    """ The autoscale evaluation interval of a pool. Raises ValueError if the Batch service would reject it. """
+    from datetime import timedelta
+
+    interval = pool_setting['autoscale'].get('interval', MIN_AUTOSCALE_INTERVAL)
+    try:
+        minutes = int(interval)
+    except (TypeError, ValueError):
+        minutes = None
+    if minutes is None or not MIN_AUTOSCALE_INTERVAL <= minutes <= MAX_AUTOSCALE_INTERVAL:
+        raise ValueError(f'The autoscale interval of pool {pool_setting["id"]} is {interval}. It must be a number of '
+                         f'minutes from {MIN_AUTOSCALE_INTERVAL} to {MAX_AUTOSCALE_INTERVAL}.')
+    return timedelta(minutes=minutes)
+
+
+def _verify_autoscale_intervals(settings: dict) -> None:
+    """ Check the autoscale intervals of all the pools before any of them is created or changed. """
+    import sys
+
+    try:
+        for pool_setting in settings['pools']:
+            if pool_setting.get('autoscale'):
+                get_autoscale_interval(pool_setting)
+    except ValueError as ex:
+        print(ex)
+        sys.exit(1)
+
 
 def _create_pools(args: argparse.Namespace) -> None:
     import sys
@@ -9,6 +69,7 @@ def _create_pools(args: argparse.Namespace) -> None:
     from miriam.verify_settings import verify_settings
 
     settings = verify_settings(args)
+    _verify_autoscale_intervals(settings)
     batch_client = create_batch_client(settings)
 
     options = dict(((sku.id, image_ref.publisher, image_ref.offer, image_ref.sku), image_ref) for sku in
@@ -29,14 +90,55 @@ def _create_pools(args: argparse.Namespace) -> None:
                                 vm_size=pool_setting['vmsize'],
                                 virtual_machine_configuration=vm_config,
                                 start_task=start_task,
-                                target_dedicated_nodes=int(pool_setting['dedicated']),
-                                target_low_priority_nodes=int(pool_setting['low-pri']),
                                 max_tasks_per_node=int(pool_setting['max-tasks']),
                                 metadata=[MetadataItem('usage', pool_setting['usage'])])
+        if pool_setting.get('autoscale'):
+            pool.enable_auto_scale = True
+            pool.auto_scale_formula = get_autoscale_formula(pool_setting)
+            pool.auto_scale_evaluation_interval = get_autoscale_interval(pool_setting)
+        else:
+            pool.target_dedicated_nodes = int(pool_setting['dedicated'])
+            pool.target_low_priority_nodes = int(pool_setting['low-pri'])
         batch_client.pool.add(pool)
 
     sys.exit(0)
 
 
+def _rescale_pools(args: argparse.Namespace) -> None:
+    """
+    Apply the size settings to the existing pools. The autoscale formula is re-applied to the pools with an autoscale
+    setting. The other pools are switched back to a fixed size if needed and resized.
+    """
+    from azure.batch.models import PoolResizeParameter
+    from miriam._utility import create_batch_client, get_logger
+    from miriam.verify_settings import verify_settings
+
+    logger = get_logger('pools')
+    settings = verify_settings(args)
+    _verify_autoscale_intervals(settings)
+    batch_client = create_batch_client(settings)
+
+    for pool_setting in settings['pools']:
+        pool_id = pool_setting['id']
+        if pool_setting.get('autoscale'):
+            batch_client.pool.enable_auto_scale(pool_id,
+                                                auto_scale_formula=get_autoscale_formula(pool_setting),
+                                                auto_scale_evaluation_interval=get_autoscale_interval(pool_setting))
+            logger.info('Autoscale formula is applied to pool %s.', pool_id)
+            continue
+
+        if batch_client.pool.get(pool_id).enable_auto_scale:
+            batch_client.pool.disable_auto_scale(pool_id)
+        batch_client.pool.resize(pool_id, PoolResizeParameter(
+            target_dedicated_nodes=int(pool_setting['dedicated']),
+            target_low_priority_nodes=int(pool_setting['low-pri'])))
+        logger.info('Pool %s is resized.', pool_id)
+
+
 def setup(subparsers) -> None:
     subparsers.add_parser('create-pools', help='Create the batch pools.').set_defaults(func=_create_pools)
+
+    pools_parser = subparsers.add_parser('pools', help='Manage the existing batch pools.')
+    pools_subparsers = pools_parser.add_subparsers(help='Pool Commands')
+    pools_subparsers.add_parser('rescale', help='Re-apply the autoscale formula or the fixed size of the pools.') \
+        .set_defaults(func=_rescale_pools)
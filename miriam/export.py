@@ -0,0 +1,139 @@
+"""
+Export the results of test runs for historical analysis, to a SQL database through ODBC or to a file.
+
+The rows are the ones of the report, streamed from the results in batches so that the memory use doesn't grow with the
+size of the run. A run exported again replaces its earlier rows in the database.
+"""
+
+import argparse
+import re
+
+COLUMNS = ['run_id', 'test_index', 'module', 'test', 'exit_code', 'duration']
+
+_SQL_TYPES = ['NVARCHAR(64) NOT NULL', 'INT NOT NULL', 'NVARCHAR(64)', 'NVARCHAR(512)', 'INT', 'FLOAT']
+
+_TABLE_NAME = re.compile(r'^[A-Za-z_][\w]*(\.[A-Za-z_][\w]*)?$')
+
+
+def iter_batches(rows, size: int = 1000):
+    from itertools import islice
+
+    rows = iter(rows)
+    batch = list(islice(rows, size))
+    while batch:
+        yield batch
+        batch = list(islice(rows, size))
+
+
+def export_to_sql(connection_string: str, table: str, run_id: str, rows, batch_size: int = 1000) -> int:
+    """
+    Insert the rows into the table with batched parameterized inserts, creating the table and its index on run_id if
+    needed. The rows of the run are replaced in one transaction. Returns the number of rows inserted.
+    """
+    import pyodbc
+
+    if not _TABLE_NAME.match(table):
+        raise ValueError(f'Invalid table name: {table}')
+
+    connection = pyodbc.connect(connection_string, autocommit=False)
+    try:
+        cursor = connection.cursor()
+        # supported from pyodbc 4.0.19, sends every batch in one round trip
+        cursor.fast_executemany = True
+
+        columns = ', '.join(f'{name} {sql_type}' for name, sql_type in zip(COLUMNS, _SQL_TYPES))
+        cursor.execute(f"IF OBJECT_ID(N'{table}', N'U') IS NULL CREATE TABLE {table} ({columns})")
+        # without it, replacing the rows of a run scans the whole history
+        index = 'ix_{}_run_id'.format(table.replace('.', '_'))
+        cursor.execute(f"IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = N'{index}' "
+                       f"AND object_id = OBJECT_ID(N'{table}')) CREATE INDEX {index} ON {table} (run_id)")
+        cursor.execute(f'DELETE FROM {table} WHERE run_id = ?', run_id)
+
+        insert = 'INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+        count = 0
+        for batch in iter_batches(rows, batch_size):
+            cursor.executemany(insert, [[run_id] + row for row in batch])
+            count += len(batch)
+
+        connection.commit()
+        return count
+    finally:
+        connection.close()
+
+
+def export_to_file(path: str, run_id: str, rows, batch_size: int = 1000) -> int:
+    """
+    Write the rows to a CSV file, compressed with gzip if the path ends with .gz, or to a Parquet file if it ends with
+    .parquet, which requires pyarrow. Returns the number of rows written.
+    """
+    count = 0
+    if path.endswith('.parquet'):
+        import pyarrow
+        import pyarrow.parquet
+
+        schema = pyarrow.schema([('run_id', pyarrow.string()), ('test_index', pyarrow.int32()),
+                                 ('module', pyarrow.string()), ('test', pyarrow.string()),
+                                 ('exit_code', pyarrow.int32()), ('duration', pyarrow.float64())])
+        with pyarrow.parquet.ParquetWriter(path, schema, compression='snappy') as writer:
+            for batch in iter_batches(rows, batch_size):
+                columns = [[run_id] * len(batch)] + [list(column) for column in zip(*batch)]
+                writer.write_table(pyarrow.Table.from_arrays(
+                    [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+                count += len(batch)
+        return count
+
+    import csv
+    import gzip
+
+    with (gzip.open(path, 'wt', newline='') if path.endswith('.gz') else open(path, 'w', newline='')) as output:
+        writer = csv.writer(output)
+        writer.writerow(COLUMNS)
+        for batch in iter_batches(rows, batch_size):
+            writer.writerows([run_id] + row for row in batch)
+            count += len(batch)
+    return count
+
+
+def _export(args: argparse.Namespace) -> None:
+    import sys
+    from miriam._utility import load_settings, get_logger
+    from miriam.cache import open_cache
+    from miriam.report import load_results, _parse_tests
+
+    if not args.sql and not args.output:
+        print('Either --sql or --output is required.', file=sys.stderr)
+        sys.exit(2)
+    if args.sql and args.output:
+        print('Only one of --sql and --output may be given.', file=sys.stderr)
+        sys.exit(2)
+
+    settings = load_settings(args.config)
+    cache = None if args.no_cache else open_cache(args.cache)
+    rows = _parse_tests(load_results(settings, args.run_id, cache, state='completed'))
+
+    if args.sql:
+        count = export_to_sql(args.sql, args.table, args.run_id, rows, args.batch_size)
+    else:
+        count = export_to_file(args.output, args.run_id, rows, args.batch_size)
+    get_logger('export').info('%d results of run %s are exported.', count, args.run_id)
+
+
+def setup(subparsers) -> None:
+    from miriam.cache import DEFAULT_CACHE_PATH
+
+    parser = subparsers.add_parser('export', help='Export the results of a test job to a database or a file.')
+    parser.add_argument('run_id', help='The test run id whose results are exported.')
+    parser.add_argument('--sql', metavar='CONNECTION_STRING',
+                        help='The ODBC connection string of the SQL database the results are inserted into.')
+    parser.add_argument('--table', default='test_results',
+                        help='The table of the SQL database. It is created if needed. Default: test_results')
+    parser.add_argument('--output', metavar='PATH',
+                        help='The file the results are written to: CSV, compressed if PATH ends with .gz, or Parquet '
+                             'if PATH ends with .parquet.')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='The number of rows inserted or written at a time. Default: 1000')
+    parser.add_argument('--cache', metavar='PATH',
+                        help=f'The path of the local results cache. Default: {DEFAULT_CACHE_PATH}')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Query the Batch service for all the results and skip the local results cache.')
+    parser.set_defaults(func=_export)
@@ -0,0 +1,94 @@
+"""
+Failover of the shards of a test run. The queued tasks of a shard whose low-priority nodes are preempted are moved to
+the shard on dedicated nodes with the largest capacity.
+"""
+
+import math
+
+
+def is_low_priority(pool_setting: dict) -> bool:
+    """ Whether the tasks of the pool run on low-priority nodes, which may be preempted. """
+    autoscale = pool_setting.get('autoscale')
+    if autoscale:
+        return bool(autoscale.get('low-pri', False))
+    return int(pool_setting.get('low-pri', 0)) > 0
+
+
+def _get_preempted_ratio(batch_client, pool_id: str) -> float:
+    """ The share of the nodes of a pool which are preempted. """
+    from azure.batch.models import ComputeNodeListOptions
+
+    nodes = list(batch_client.compute_node.list(pool_id, compute_node_list_options=ComputeNodeListOptions(
+        select='id,state')))
+    preempted = sum(1 for node in nodes if getattr(node.state, 'value', node.state) == 'preempted')
+    return preempted / len(nodes) if nodes else 0.0
+
+
+def _get_output_container_url(job) -> str:
+    return next(setting.value for setting in job.common_environment_settings
+                if setting.name == 'AUTOMATION_OUTPUT_CONTAINER')
+
+
+def _move_queued_tasks(batch_client, job, target, ratio: float, cache=None) -> int:
+    """
+    Move the given share of the queued tasks of a job to the target job. The tasks are added to the target job before
+    they are deleted from their job, so a test is never lost. Returns the number of tasks moved.
+    """
+    from azure.batch.models import TaskListOptions
+    from miriam.cache import delete_tasks
+    from miriam.jobs import clone_task
+    from miriam.submit import submit_tasks
+
+    target_url = _get_output_container_url(target)
+    queued = [task for task in batch_client.task.list(job.id, task_list_options=TaskListOptions(
+        filter="state eq 'active'")) if task.id != 'test-creator']
+    queued = queued[:math.ceil(len(queued) * ratio)]
+    rejected = set(task.id for task in submit_tasks(batch_client, target.id,
+                                                    [clone_task(task, target_url) for task in queued]))
+    queued = [task for task in queued if task.id not in rejected]
+    for task in queued:
+        batch_client.task.delete(job.id, task.id)
+    if cache:
+        delete_tasks(cache, job.id, [task.id for task in queued])
+    return len(queued)
+
+
+def failover_shards(settings: dict, run_id: str, cache=None) -> int:
+    """
+    Move the queued tasks of the shards whose low-priority nodes are preempted to the active shard with the largest
+    dedicated capacity. A share of the queued tasks equal to the share of preempted nodes is moved. Returns the number
+    of tasks moved.
+    """
+    from azure.batch.models import JobState
+    from miriam._utility import create_batch_client, get_logger
+    from miriam.jobs import list_shards
+    from miriam.scheduling import get_pool_slots
+    from miriam.sharding import get_test_pools
+
+    logger = get_logger('failover')
+    batch_client = create_batch_client(settings)
+    pools = dict((p['id'], p) for p in get_test_pools(settings))
+    jobs = [batch_client.job.get(job_id) for job_id in [run_id] + list_shards(settings, run_id)]
+
+    targets = [job for job in jobs if job.state == JobState.active and job.pool_info.pool_id in pools and
+               not is_low_priority(pools[job.pool_info.pool_id])]
+    if not targets:
+        return 0
+    target = max(targets, key=lambda job: get_pool_slots(pools[job.pool_info.pool_id]))
+
+    moved = 0
+    for job in jobs:
+        pool_setting = pools.get(job.pool_info.pool_id)
+        if job.state != JobState.active or not pool_setting or not is_low_priority(pool_setting):
+            continue
+
+        ratio = _get_preempted_ratio(batch_client, pool_setting['id'])
+        if not ratio:
+            continue
+
+        count = _move_queued_tasks(batch_client, job, target, ratio, cache)
+        moved += count
+        logger.warning('%.0f%% of the nodes of pool %s are preempted. %d queued tasks of job %s are moved to job %s.',
+                       ratio * 100, pool_setting['id'], count, job.id, target.id)
+
+    return moved
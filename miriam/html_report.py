@@ -0,0 +1,77 @@
+import os
+from collections import namedtuple
+
+# The logs of the rows of a report. If log_dir is set, every log is saved in its own text file in that directory.
+ReportLogs = namedtuple('ReportLogs', ['logs', 'log_dir'])
+ReportLogs.__new__.__defaults__ = (None,)
+
+_PAGE_HEAD = """<html>
+<head>
+<title>Test results {run_id}</title>
+<link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css" integrity="sha384-BVYiiSIFeK1dGmJRAkycuHAHRg32OmUcww7on3RYdg4Va+PmSTsz/K68vbdEjh4u" crossorigin="anonymous">
+</head>
+<body>
+<div class='container'>
+<div class='row'>
+<h1>Azure CLI Automation Result</h1>
+<dl class="dl-horizontal">
+  <dt>Run ID</dt>
+  <dd>{run_id}</dd>
+</dl>
+</div>
+<div class='row'>
+<table class="table table-condensed table-striped">
+"""
+
+_PAGE_TAIL = """</div>
+</body>
+</html>
+"""
+
+
+def _format_cell(value) -> str:
+    from html import escape
+    return '' if value is None else escape(str(value))
+
+
+def write_html_report(path: str, run_id: str, headers: list, rows, logs: ReportLogs = None) -> None:
+    """
+    Write the HTML report row by row so that the memory use doesn't grow with the size of the run.
+
+    The logs, if given, are consumed along with the rows. By default they are spooled to a temporary file while the
+    table is written and appended to the page after it. If their log_dir is set, every log is saved in its own text
+    file in that directory, next to the page, and the table links to it so that a log is loaded only when it is opened.
+    """
+    import shutil
+    import tempfile
+    from html import escape
+
+    log_dir = logs.log_dir if logs else None
+    if logs is not None:
+        logs = iter(logs.logs)
+    if log_dir:
+        os.makedirs(os.path.join(os.path.dirname(os.path.abspath(path)), log_dir), exist_ok=True)
+
+    with open(path, 'w') as page, tempfile.TemporaryFile('w+') as spool:
+        page.write(_PAGE_HEAD.format(run_id=escape(run_id)))
+        page.write('<thead><tr>{}</tr></thead>\n<tbody>\n'.format(''.join(f'<th>{escape(h)}</th>' for h in headers)))
+
+        for index, row in enumerate(rows):
+            cells = [_format_cell(cell) for cell in row]
+            if logs is not None:
+                log = next(logs)
+                if log_dir:
+                    log_path = f'{log_dir}/{index}.txt'
+                    with open(os.path.join(os.path.dirname(os.path.abspath(path)), log_path), 'w') as log_file:
+                        log_file.write(log)
+                    cells.append(f'<a href="{escape(log_path)}" target="_blank">Log</a>')
+                else:
+                    spool.write(f'<div class=\'row\'><h4 id="{index}">{_format_cell(row[2])}</h4>'
+                                f'<pre><code>{escape(log)}</code></pre></div>\n')
+                    cells.append(f'<a href="#{index}">Log</a>')
+            page.write('<tr>{}</tr>\n'.format(''.join(f'<td>{cell}</td>' for cell in cells)))
+
+        page.write('</tbody>\n</table>\n</div>\n')
+        spool.seek(0)
+        shutil.copyfileobj(spool, page)
+        page.write(_PAGE_TAIL)
@@ -0,0 +1,117 @@
+"""
+Test impact analysis: select the test modules affected by the changes between the commits of two builds.
+
+A changed file under a command module selects the tests of that module, named like the report names them. A changed
+file outside of the command modules may affect any test, so it selects the whole suite, unless it matches one of the
+ignored patterns. The modules listed as always run are added to any selection. Both lists come from the optional
+'impact' section of the settings:
+
+    impact:
+      always-run: [CORE]
+      ignore: ['*.md', 'doc/*']
+"""
+
+import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from azure.batch import BatchServiceClient
+    from azure.storage.blob import BlockBlobService
+
+DEFAULT_ALWAYS_RUN = ['CORE']
+DEFAULT_IGNORE = ['*.md', '*.rst', 'doc/*', '.github/*']
+DEFAULT_MIRROR_DIR = '~/.miriam/git'
+
+_MODULE_PATHS = [re.compile(r'(?:^|/)azure/cli/command_modules/(?P<module>[^/]+)/'),
+                 re.compile(r'(?:^|/)command_modules/azure-cli-(?P<module>[^/]+)/')]
+
+
+def get_build_commit(batch_client: 'BatchServiceClient', storage_client: 'BlockBlobService', build_id: str) -> str:
+    """ The commit a build is made of, read from the metadata of the build job or, once it is gone, of the builds. """
+    from azure.batch.models import BatchErrorException, JobGetOptions
+    from azure.storage.blob.models import Include
+
+    try:
+        job = batch_client.job.get(build_id, job_get_options=JobGetOptions(select='id,metadata'))
+        commit = next((item.value for item in job.metadata or [] if item.name == 'commit'), None)
+        if commit:
+            return commit
+    except BatchErrorException:
+        pass
+
+    for blob in storage_client.list_blobs('builds', prefix='commits/', include=Include.METADATA):
+        if blob.metadata and blob.metadata.get('build_id') == build_id:
+            return blob.metadata['commit']
+    raise ValueError(f'The commit of build {build_id} is not known.')
+
+
+def list_changed_files(url: str, base: str, head: str, mirror_dir: str = None) -> list:
+    """
+    List the files changed between two commits of the remote repository. The repository is mirrored in a local bare
+    clone which is only fetched on later calls.
+    """
+    import hashlib
+    import os
+    import subprocess
+
+    mirror_dir = os.path.expanduser(mirror_dir or DEFAULT_MIRROR_DIR)
+    path = os.path.join(mirror_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.git')
+    if os.path.exists(path):
+        subprocess.check_call(['git', '--git-dir', path, 'fetch', '--quiet', '--prune', 'origin'])
+    else:
+        os.makedirs(mirror_dir, exist_ok=True)
+        subprocess.check_call(['git', 'clone', '--quiet', '--mirror', '--', url, path])
+
+    output = subprocess.check_output(['git', '--git-dir', path, 'diff', '--name-only', f'{base}...{head}'],
+                                     universal_newlines=True)
+    return [line for line in output.split('\n') if line]
+
+
+def map_modules(paths: list, ignore: list = None) -> set:
+    """ The modules affected by the changed files, or None if a change may affect any test. """
+    from fnmatch import fnmatch
+
+    modules = set()
+    for path in paths:
+        match = next((m for m in (pattern.search(path) for pattern in _MODULE_PATHS) if m), None)
+        if match:
+            modules.add(match.group('module').replace('-', '_').upper())
+        elif not any(fnmatch(path, pattern) for pattern in (DEFAULT_IGNORE if ignore is None else ignore)):
+            return None
+    return modules
+
+
+def select_modules(settings: dict, build_id: str, baseline_build_id: str) -> set:
+    """ The test modules to run for a build compared to a baseline build, or None to run the whole suite. """
+    from miriam._utility import create_batch_client, create_storage_client, get_logger
+
+    logger = get_logger('impact')
+    impact = settings.get('impact') or {}
+    batch_client = create_batch_client(settings)
+    storage_client = create_storage_client(settings)
+
+    base = get_build_commit(batch_client, storage_client, baseline_build_id)
+    head = get_build_commit(batch_client, storage_client, build_id)
+    paths = list_changed_files(settings['gitsource']['url'], base, head, impact.get('mirror'))
+
+    modules = map_modules(paths, impact.get('ignore'))
+    if modules is None:
+        logger.info('%d files changed between %s and %s, some outside of the command modules. All the tests run.',
+                    len(paths), base, head)
+        return None
+
+    modules.update(module.upper() for module in impact.get('always-run', DEFAULT_ALWAYS_RUN))
+    logger.info('%d files changed between %s and %s. The tests of %s run.', len(paths), base, head,
+                ', '.join(sorted(modules)))
+    return modules
+
+
+def is_selected(test_name: str, modules: set) -> bool:
+    """
+    Whether a test, given by its full name or its test class, belongs to the selected modules. Tests whose module is
+    unknown always run.
+    """
+    from miriam._utility import get_test_module
+
+    module = get_test_module(test_name)
+    return modules is None or module is None or module in modules
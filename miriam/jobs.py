@@ -0,0 +1,93 @@
+"""
+The jobs making up a test run. The first job has the run id. The jobs of the other test pools are named
+'<run id>-shard<n>' and the jobs rerunning failed tests '<run id>-rerun<n>'. The results of a run merge the results of
+all these jobs and refer to the tasks of the jobs beyond the first one as '<job id>/<task id>'.
+"""
+
+import re
+
+SHARD_SUFFIX = '-shard'
+RERUN_SUFFIX = '-rerun'
+
+
+def get_shard_id(run_id: str, index: int) -> str:
+    return run_id if index == 0 else f'{run_id}{SHARD_SUFFIX}{index}'
+
+
+def get_rerun_id(run_id: str, attempt: int) -> str:
+    return f'{run_id}{RERUN_SUFFIX}{attempt}'
+
+
+def split_attempt_id(run_id: str, task_id: str) -> tuple:
+    """ Returns the job and the task id of a task of the merged results of a run. """
+    # the tasks of the other jobs of the run, reruns and shards, are prefixed by their job id
+    if task_id.startswith(f'{run_id}-'):
+        job_id, _, task_id = task_id.partition('/')
+        return job_id, task_id
+    return run_id, task_id
+
+
+def list_run_jobs(settings: dict, run_id: str, suffix: str) -> list:
+    """ Returns the ids of the jobs named '<run id><suffix><n>' in the order of n. """
+    from azure.batch.models import JobListOptions
+    from miriam._utility import create_batch_client
+
+    pattern = re.compile(r'^{}{}(\d+)$'.format(re.escape(run_id), re.escape(suffix)))
+    options = JobListOptions(filter=f"startswith(id, '{run_id}{suffix}')", select='id')
+
+    jobs = {}
+    for job in create_batch_client(settings).job.list(job_list_options=options):
+        match = pattern.match(job.id)
+        if match:
+            jobs[int(match.group(1))] = job.id
+    return [jobs[index] for index in sorted(jobs)]
+
+
+def list_shards(settings: dict, run_id: str) -> list:
+    """ Returns the ids of the jobs of a run beyond the first one, in the order of the shards. """
+    return list_run_jobs(settings, run_id, SHARD_SUFFIX)
+
+
+def list_reruns(settings: dict, run_id: str) -> list:
+    """ Returns the ids of the rerun jobs of a run in the order they were created. """
+    return list_run_jobs(settings, run_id, RERUN_SUFFIX)
+
+
+def merge_attempts(run_id: str, attempts: list):
+    """
+    Merge the tasks of the given (job id, tasks) attempts of a run into one result per test. The tests are listed in
+    the order of the first attempt and the result of the latest attempt of a test takes precedence.
+    """
+    from collections import OrderedDict
+    from miriam.cache import TaskRecord
+
+    results = OrderedDict()
+    for job_id, tasks in attempts:
+        for task in tasks:
+            if job_id != run_id:
+                task = TaskRecord(f'{job_id}/{task.id}', task.display_name, task.state, task.execution_info)
+            results[task.display_name] = task
+    return iter(results.values())
+
+
+def _redirect_output_files(output_files: list, output_container_url: str) -> list:
+    """ Point the output files of a cloned task to the output container of another job. """
+    for output_file in output_files or []:
+        container = output_file.destination.container
+        if container:
+            container.container_url = output_container_url
+    return output_files
+
+
+def clone_task(task, output_container_url: str):
+    """ Clone the definition of a task to add it to another job of the run, writing to the given output container. """
+    from azure.batch.models import TaskAddParameter
+
+    return TaskAddParameter(id=task.id,
+                            display_name=task.display_name,
+                            command_line=task.command_line,
+                            resource_files=task.resource_files,
+                            environment_settings=task.environment_settings,
+                            output_files=_redirect_output_files(task.output_files, output_container_url),
+                            constraints=task.constraints,
+                            user_identity=task.user_identity)
@@ -0,0 +1,96 @@
+"""
+A cache of installed builds kept on the nodes of a pool across test jobs.
+
+With the cache, the job preparation task installs a build in $AZ_BATCH_NODE_SHARED_DIR/miriam-cache/builds/<build id>
+and links $AZ_BATCH_NODE_SHARED_DIR/app to the app directory of the installed build. A later job of the same build on
+the node only links it again. The pip cache is shared by the builds of the same dependencies, found by the hash of the
+app/requirements*.txt files, in miriam-cache/pip/<hash>. install.sh runs from the root of the build as before, and is
+expected to install relative to it.
+
+An archived build is downloaded by the preparation task itself, only on a cache miss. A build of separate files is still
+downloaded by the Batch service as resource files, and only its installation is skipped on a hit.
+
+Once the cache is larger than its size cap, the least recently used builds and pip caches are removed. The cache is
+locked while a build is installed or removed. A build is marked in use by every job preparing it, in
+miriam-cache/builds/<build id>/.jobs/<job id>, until the job release task of that job removes the mark. The builds in
+use and their pip caches are never removed, so the jobs of different builds can share the pools. The app link is as
+shared as the app directory installed without the cache though: it refers to the build of the job prepared last on the
+node.
+"""
+
+_PREP_SCRIPT = r"""set -e -o pipefail
+cache="$AZ_BATCH_NODE_SHARED_DIR/miriam-cache"
+entry="$cache/builds/$MIRIAM_BUILD_ID"
+mkdir -p "$cache/builds" "$cache/pip"
+exec 9> "$cache/lock"
+flock 9
+if [ -f "$entry/.complete" ]; then
+  echo "Build $MIRIAM_BUILD_ID is found in the node cache."
+  deps=$(cat "$entry/.deps")
+else
+  rm -rf "$entry"; mkdir -p "$entry"
+  if [ -n "$MIRIAM_BUILD_ARCHIVE_URL" ]; then
+    curl -sSf --retry 3 -o "$entry/{archive}" "$MIRIAM_BUILD_ARCHIVE_URL"
+    curl -sSf --retry 3 -o "$entry/{manifest}" "$MIRIAM_BUILD_MANIFEST_URL"
+    (cd "$entry" && tar -xzf {archive} && sha256sum --check --quiet {manifest} && rm {archive})
+  else
+    cp -r "$AZ_BATCH_TASK_WORKING_DIR/." "$entry/"
+  fi
+  deps=$(cat "$entry"/app/requirements*.txt 2>/dev/null | sha256sum | cut -c1-16)
+  echo "$deps" > "$entry/.deps"
+  mkdir -p "$cache/pip/$deps"
+  (cd "$entry" && PIP_CACHE_DIR="$cache/pip/$deps" ./app/install.sh)
+  touch "$entry/.complete"
+fi
+mkdir -p "$entry/.jobs"
+touch "$entry/.jobs/$AZ_BATCH_JOB_ID" "$entry" "$cache/pip/$deps"
+[ -L "$AZ_BATCH_NODE_SHARED_DIR/app" ] || rm -rf "$AZ_BATCH_NODE_SHARED_DIR/app"
+ln -sfn "$entry/app" "$AZ_BATCH_NODE_SHARED_DIR/app"
+in_use() {
+  for mark in "$cache"/builds/*/.jobs/*; do
+    [ -e "$mark" ] || continue
+    echo "${mark%/.jobs/*}"
+    echo "$cache/pip/$(cat "${mark%/.jobs/*}/.deps")"
+  done
+}
+while [ "$(du -sm "$cache" | cut -f1)" -gt "$MIRIAM_CACHE_MAX_MB" ]; do
+  oldest=$(ls -1dtr "$cache"/builds/* "$cache"/pip/* | grep -vxF -f <(in_use) | head -n 1) || true
+  [ -n "$oldest" ] || break
+  echo "Removing $oldest from the node cache."
+  rm -rf "$oldest"
+done"""
+
+_RELEASE_SCRIPT = 'rm -f "$AZ_BATCH_NODE_SHARED_DIR/miriam-cache/builds/$MIRIAM_BUILD_ID/.jobs/$AZ_BATCH_JOB_ID"'
+
+
+def create_cached_prep_task(build_id: str, max_size_mb: int, archive_files: list = None, resource_files: list = None):
+    """
+    Create the job preparation task installing the build through the node cache. archive_files are the resource files
+    of the build archive and its manifest, whose urls are downloaded on a cache miss. Otherwise the resource_files of
+    the build are downloaded by the Batch service.
+    """
+    import shlex
+    from azure.batch.models import JobPreparationTask, EnvironmentSetting
+    from miriam.schedule_build import BUILD_ARCHIVE, BUILD_MANIFEST
+
+    environment = [EnvironmentSetting(name='MIRIAM_BUILD_ID', value=build_id),
+                   EnvironmentSetting(name='MIRIAM_CACHE_MAX_MB', value=str(max_size_mb))]
+    if archive_files:
+        archive_url, manifest_url = (resource_file.blob_source for resource_file in archive_files)
+        environment.append(EnvironmentSetting(name='MIRIAM_BUILD_ARCHIVE_URL', value=archive_url))
+        environment.append(EnvironmentSetting(name='MIRIAM_BUILD_MANIFEST_URL', value=manifest_url))
+
+    script = _PREP_SCRIPT.replace('{archive}', BUILD_ARCHIVE).replace('{manifest}', BUILD_MANIFEST)
+    return JobPreparationTask('/bin/bash -c {}'.format(shlex.quote(script)),
+                              resource_files=None if archive_files else resource_files,
+                              environment_settings=environment,
+                              wait_for_success=True)
+
+
+def create_cached_release_task(build_id: str):
+    """ Create the job release task removing the mark of the job on the build it prepared in the node cache. """
+    import shlex
+    from azure.batch.models import JobReleaseTask, EnvironmentSetting
+
+    return JobReleaseTask('/bin/bash -c {}'.format(shlex.quote(_RELEASE_SCRIPT)),
+                          environment_settings=[EnvironmentSetting(name='MIRIAM_BUILD_ID', value=build_id)])
@@ -0,0 +1,127 @@
+"""
+Size the test pool by simulating a run of the suite on different pool configurations.
+
+The simulation replays the test durations of an existing run. Every node becomes available once its job preparation
+is done, then each of its max-tasks slots takes the next queued test as soon as it is free. The contention between
+the tasks running on the same node is not modeled, so the predictions for many tasks per node are optimistic.
+"""
+
+import argparse
+import heapq
+
+
+def get_run_durations(settings: dict, run_id: str, cache=None) -> list:
+    """ The durations of the tests of a run, in the order they started. """
+    from miriam.cache import to_utc
+    from miriam.report import load_results
+
+    tests = []
+    for task in load_results(settings, run_id, cache, state='completed'):
+        info = task.execution_info
+        if info and info.start_time and info.end_time:
+            tests.append((to_utc(info.start_time), (to_utc(info.end_time) - to_utc(info.start_time)).total_seconds()))
+    return [seconds for _, seconds in sorted(tests, key=lambda test: test[0])]
+
+
+def get_prep_seconds(settings: dict, run_id: str) -> float:
+    """ The median duration of the job preparation on the nodes of the jobs of a run, or 0 if it is unknown. """
+    from miriam._utility import create_batch_client
+    from miriam.jobs import list_shards
+
+    batch_client = create_batch_client(settings)
+    samples = []
+    for job_id in [run_id] + list_shards(settings, run_id):
+        for status in batch_client.job.list_preparation_and_release_task_status(job_id):
+            info = status.job_preparation_task_execution_info
+            if info and info.start_time and info.end_time:
+                samples.append((info.end_time - info.start_time).total_seconds())
+    return sorted(samples)[len(samples) // 2] if samples else 0.0
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
+
+def simulate(durations: list, nodes: int, max_tasks: int, prep_seconds: float = 0,
+             task_overhead: float = 0) -> float:
+    """ Returns the makespan of the tests run in the given order on the pool, including the node preparation. """
+    slots = [prep_seconds] * (nodes * max_tasks)
+    heapq.heapify(slots)
+    makespan = prep_seconds
+    for seconds in durations:
+        end = heapq.heappop(slots) + task_overhead + seconds
+        makespan = max(makespan, end)
+        heapq.heappush(slots, end)
+    return makespan
+
+
+def plan_pool(durations: list, node_counts: list, max_tasks_values: list, prep_seconds: float = 0,
+              task_overhead: float = 0) -> list:
+    """ Simulate every configuration. Returns the (nodes, max tasks, makespan, node hours) of each. """
+    results = []
+    for nodes in node_counts:
+        for max_tasks in max_tasks_values:
+            makespan = simulate(durations, nodes, max_tasks, prep_seconds, task_overhead)
+            results.append((nodes, max_tasks, makespan, nodes * makespan / 3600))
+    return results
+
+
+def _plan_pool(args: argparse.Namespace) -> None:
+    import sys
+    import tabulate
+    from miriam._utility import load_settings
+    from miriam.cache import open_cache
+    from miriam.scheduling import order_longest_first
+
+    settings = load_settings(args.config)
+    durations = get_run_durations(settings, args.run_id, None if args.no_cache else open_cache(args.cache))
+    if not durations:
+        print(f'No completed test is found in run {args.run_id}.', file=sys.stderr)
+        sys.exit(1)
+    if args.longest_first:
+        durations = [durations[index] for index in order_longest_first(dict(enumerate(durations)))]
+
+    prep_seconds = args.prep_seconds if args.prep_seconds is not None else get_prep_seconds(settings, args.run_id)
+    results = plan_pool(durations, args.nodes, args.max_tasks, prep_seconds, args.task_overhead)
+
+    target = args.target * 60 if args.target else None
+    cheapest = min((result for result in results if target is None or result[2] <= target),
+                   key=lambda result: (result[3], result[2]), default=None)
+
+    print(f'{len(durations)} tests, {sum(durations) / 3600:.1f} test hours, {prep_seconds:.0f} seconds of node '
+          f'preparation.')
+    print(tabulate.tabulate([[nodes, max_tasks, makespan / 60, node_hours,
+                              '*' if (nodes, max_tasks, makespan, node_hours) == cheapest else '']
+                             for nodes, max_tasks, makespan, node_hours in results],
+                            headers=['Nodes', 'Max Tasks', 'Makespan (min)', 'Node Hours', 'Cheapest'],
+                            floatfmt='.1f'))
+    if target and not cheapest:
+        print(f'No configuration finishes within {args.target} minutes.')
+        sys.exit(1)
+
+
+def setup(subparsers) -> None:
+    from miriam.cache import DEFAULT_CACHE_PATH
+
+    parser = subparsers.add_parser('plan-pool', help='Predict the run time and cost of pool sizes from a test job.')
+    parser.add_argument('run_id', help='The test run id whose test durations are replayed.')
+    parser.add_argument('--nodes', type=_positive_int, nargs='+', default=[5, 10, 20, 40],
+                        help='The node counts to simulate. Default: 5 10 20 40')
+    parser.add_argument('--max-tasks', type=_positive_int, nargs='+', default=[1, 2, 4],
+                        help='The max tasks per node values to simulate. Default: 1 2 4')
+    parser.add_argument('--prep-seconds', type=float,
+                        help='The job preparation time of a node. Default: the median one in the run.')
+    parser.add_argument('--task-overhead', type=float, default=0, metavar='SECONDS',
+                        help='The scheduling overhead added to every task. Default: 0')
+    parser.add_argument('--longest-first', action='store_true',
+                        help='Run the tests the longest first, as with a test plan, instead of the order of the run.')
+    parser.add_argument('--target', type=float, metavar='MINUTES',
+                        help='Mark the cheapest configuration finishing within the given minutes.')
+    parser.add_argument('--cache', metavar='PATH',
+                        help=f'The path of the local results cache. Default: {DEFAULT_CACHE_PATH}')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Query the Batch service for all the results and skip the local results cache.')
+    parser.set_defaults(func=_plan_pool)
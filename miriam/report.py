@@ -1,75 +1,312 @@
 import argparse
-from azure.batch.models import CloudTask
+from collections import namedtuple
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:
+    from azure.batch.models import CloudTask
 
-def _get_task_log(run_id: str, task: CloudTask, settings: dict) -> str:
-    import os.path
-    import requests
-    from datetime import datetime, timedelta
 
-    from azure.storage.blob.models import BlobPermissions
-    from miriam._utility import create_storage_client
+LOG_PREAMBLE_LINES = 58
+LOG_EPILOGUE_LINES = 3
+
+# The logs are downloaded by workers threads. If tail_kb is set, only the last tail_kb kilobytes of each log are read.
+LogOptions = namedtuple('LogOptions', ['workers', 'tail_kb'])
+LogOptions.__new__.__defaults__ = (8, 0)
+
+
+def _trim_log_lines(lines):
+    """ Skip the preamble and the epilogue of a test log without holding the whole log in memory. """
+    from collections import deque
+    from itertools import islice
+
+    buffer = deque()
+    for line in islice(lines, LOG_PREAMBLE_LINES, None):
+        buffer.append(line)
+        if len(buffer) > LOG_EPILOGUE_LINES:
+            yield buffer.popleft()
+
+
+def _iter_task_log(session, url: str, timeout: int = 60):
+    """ Stream the trimmed lines of a log blob. """
+    with session.get(url, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        response.encoding = response.encoding or 'utf-8'
+        yield from _trim_log_lines(response.iter_lines(decode_unicode=True))
+
+
+def _read_task_log_tail(session, url: str, tail_bytes: int, timeout: int = 60) -> str:
+    """
+    Read only the last bytes of a log blob with a ranged GET. The size of the blob is queried first so that the whole
+    log is downloaded only if it is smaller than the requested tail.
+    """
+    response = session.head(url, timeout=timeout)
+    response.raise_for_status()
+    size = int(response.headers['Content-Length'])
+    if size <= tail_bytes:
+        return '\n'.join(_iter_task_log(session, url, timeout))
+
+    response = session.get(url, timeout=timeout, headers={'x-ms-range': f'bytes={size - tail_bytes}-{size - 1}'})
+    response.raise_for_status()
+    response.encoding = response.encoding or 'utf-8'
+
+    # the first line is likely cut in the middle
+    lines = response.text.split('\n')[1:-LOG_EPILOGUE_LINES]
+    return '\n'.join([f'... ({size - tail_bytes} bytes skipped)'] + lines)
+
+
+def _create_log_session(run_id: str, settings: dict, workers: int = 8):
+    """
+    Returns the shared HTTP session and a function which maps a task to the url of its log blob. The urls of a container
+    share one read only container SAS.
+    """
+    from azure.storage.blob.models import ContainerPermissions
+    from miriam._utility import create_storage_client, get_container_sas, get_http_session
+    from miriam.jobs import split_attempt_id
 
     storage = create_storage_client(settings)
+    session = get_http_session(workers)
+
+    def _get_log_url(task: 'CloudTask') -> str:
+        # the tasks of the reruns write their logs to the output container of their own job
+        job_id, task_id = split_attempt_id(run_id, task.id)
+        container_name = f'output-{job_id}'
+        sas = get_container_sas(storage, container_name, ContainerPermissions(read=True), protocol='https')
+        return storage.make_blob_url(container_name, f'{task_id}/stdout.txt', sas_token=sas, protocol='https')
 
-    blob_name = os.path.join(task.id, 'stdout.txt')
-    container_name = f'output-{run_id}'
-    sas = storage.generate_blob_shared_access_signature(container_name, blob_name,
-                                                        permission=BlobPermissions(read=True),
-                                                        protocol='https',
-                                                        expiry=(datetime.utcnow() + timedelta(weeks=52)))
-    url = storage.make_blob_url(container_name, blob_name, sas_token=sas, protocol='https')
+    return session, _get_log_url
 
-    response = requests.request('GET', url)
-    return '\n'.join(response.text.split('\n')[58:-3])
 
+def _iter_task_logs(run_id: str, tasks: list, settings: dict, options: LogOptions = None, timeout: int = 60):
+    """
+    Download the stdout logs of the given tasks concurrently. The logs are yielded in the same order as the tasks.
 
-def _query_results(settings: dict, run_id: str, failed_only: bool = False):
+    At most twice as many logs as workers are downloaded ahead of the consumer, so the memory use doesn't grow with the
+    number of tasks. The requests go through the shared HTTP session. A log which can't be retrieved is yielded as None
+    instead of failing the report.
+    """
+    import requests
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from miriam._utility import get_logger
+
+    logger = get_logger('report')
+    workers, tail_kb = options or LogOptions()
+    session, get_log_url = _create_log_session(run_id, settings, workers)
+
+    def _get_task_log(task: 'CloudTask') -> str:
+        url = get_log_url(task)
+        try:
+            if tail_kb:
+                return _read_task_log_tail(session, url, tail_kb * 1024, timeout)
+            return '\n'.join(_iter_task_log(session, url, timeout))
+        except requests.RequestException as ex:
+            logger.warning('Failed to retrieve the log of task %s: %s', task.id, ex)
+            return None
+
+    logger.info('Downloading %d logs with %d workers.', len(tasks), workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        window = deque()
+        for task in tasks:
+            window.append(executor.submit(_get_task_log, task))
+            if len(window) >= workers * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def _query_results(settings: dict, run_id: str, failed_only: bool = False, state: str = None):
+    """
+    List the test tasks of a run. The filters are evaluated by the Batch service and only the properties needed by the
+    report are returned. The tasks are yielded page by page as they are received.
+    """
+    from azure.batch.models import TaskListOptions
     from miriam._utility import create_batch_client
 
+    filters = []
+    if failed_only:
+        # a task failed before its command line ran, e.g. on a resource file, has no exit code
+        filters.append("(executionInfo/exitCode ne 0 or executionInfo/result eq 'failure')")
+    if state:
+        filters.append(f"state eq '{state}'")
+
+    options = TaskListOptions(filter=' and '.join(filters) or None,
+                              select='id,displayName,state,executionInfo',
+                              max_results=1000)
+
     batch = create_batch_client(settings)
-    for task in batch.task.list(run_id):  # try use OData filter. But I hate OData!
-        if task.execution_info.exit_code == 0 and failed_only:
-            continue
+    for task in batch.task.list(run_id, task_list_options=options):
         if task.id == 'test-creator':
             continue
         yield task
 
 
+def _list_changed_tasks(batch, run_id: str, watermark) -> tuple:
+    """
+    List the test tasks of a run whose state changed since the watermark, all of them if it is None. Returns the tasks
+    and the new watermark, the latest state transition seen.
+    """
+    from datetime import timedelta
+    from azure.batch.models import TaskListOptions
+    from miriam.cache import to_utc
+
+    options = TaskListOptions(select='id,displayName,state,stateTransitionTime,executionInfo', max_results=1000)
+    if watermark:
+        # tolerate the delay between a state transition and its visibility in the list
+        since = watermark - timedelta(minutes=1)
+        options.filter = "stateTransitionTime ge datetime'{}'".format(since.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    changed = []
+    for task in batch.task.list(run_id, task_list_options=options):
+        if task.id == 'test-creator':
+            continue
+        changed.append(task)
+        transition = to_utc(task.state_transition_time)
+        if transition and (not watermark or transition > watermark):
+            watermark = transition
+    return changed, watermark
+
+
+def sync_results(settings: dict, cache, run_id: str) -> None:
+    """
+    Bring the cached tasks of a run up to date. Only the tasks whose state changed since the last synchronization are
+    listed. Once the job is completed and all its tasks are cached as completed, the run is served from the cache only.
+    """
+    from azure.batch.models import JobGetOptions, JobState
+    from miriam._utility import create_batch_client, get_logger
+    from miriam.cache import get_run, save_run, save_tasks, count_incomplete_tasks
+    from miriam.scheduling import record_durations
+    from miriam.bundle import expand_bundles
+
+    logger = get_logger('report')
+    run = get_run(cache, run_id)
+    if run and run.completed:
+        logger.info('Run %s is completed. The results are served from the cache.', run_id)
+        return
+
+    batch = create_batch_client(settings)
+
+    # the job state is read before the tasks so that a task completed in between is not missed
+    job = batch.job.get(run_id, job_get_options=JobGetOptions(select='id,state'))
+
+    changed, watermark = _list_changed_tasks(batch, run_id, run.watermark if run else None)
+    changed = list(expand_bundles(changed, run_id, settings))
+    save_tasks(cache, run_id, changed)
+    record_durations(cache, run_id, changed)
+    completed = job.state == JobState.completed and not count_incomplete_tasks(cache, run_id)
+    save_run(cache, run_id, watermark, completed)
+    logger.info('%d changed tasks of run %s are cached.', len(changed), run_id)
+
+
+def load_results(settings: dict, run_id: str, cache=None, failed_only: bool = False, state: str = None):
+    """
+    List the test results of a run merged with the results of its shards and reruns. With a cache, the results are
+    synchronized into the cache and read from it. Otherwise they are queried from the Batch service.
+
+    The ids of the shards and reruns are recorded in the cache. The shards of a completed run don't change, so only its
+    reruns are listed again, in one call, to find the reruns created by others or through another cache.
+    """
+    from miriam.bundle import expand_bundles
+    from miriam.cache import list_tasks, get_run, save_run_jobs
+    from miriam.jobs import SHARD_SUFFIX, list_shards, list_reruns, merge_attempts
+
+    def _load(job_id: str, failed: bool, job_state: str):
+        if cache is None:
+            return expand_bundles(_query_results(settings, job_id, failed, job_state), job_id, settings, failed)
+        sync_results(settings, cache, job_id)
+        return list_tasks(cache, job_id, failed, job_state)
+
+    run = get_run(cache, run_id) if cache is not None else None
+    if run and run.completed and run.jobs is not None:
+        shards = [job_id for job_id in run.jobs if job_id.startswith(f'{run_id}{SHARD_SUFFIX}')]
+    else:
+        shards = list_shards(settings, run_id)
+    others = shards + list_reruns(settings, run_id)
+    if cache is not None and (not run or others != run.jobs):
+        save_run_jobs(cache, run_id, others)
+    if not others:
+        return _load(run_id, failed_only, state)
+
+    # a test failed in one attempt may pass in a later one, so the filters apply to the merged results
+    def _is_failed(task) -> bool:
+        info = task.execution_info
+        if info and info.exit_code is not None:
+            return info.exit_code != 0
+        # a completed task without exit code failed before its command line ran
+        return getattr(task.state, 'value', task.state) == 'completed'
+
+    def _matches(task) -> bool:
+        if failed_only and not _is_failed(task):
+            return False
+        return not state or getattr(task.state, 'value', task.state) == state
+
+    tasks = merge_attempts(run_id, [(job_id, _load(job_id, False, None)) for job_id in [run_id] + others])
+    return (task for task in tasks if _matches(task))
+
+
+def _load_task_logs(run_id: str, tasks: list, settings: dict, cache=None, options: LogOptions = None):
+    """
+    Yield the logs of the given tasks in order. Only the logs not found in the cache are downloaded. The downloaded logs
+    are saved to the cache by batches, the last one along with the log of the last task.
+    """
+    from miriam.cache import list_log_ids, get_log, save_logs
+
+    options = options or LogOptions()
+    tail_kb = options.tail_kb
+    cached = list_log_ids(cache, run_id, tail_kb) if cache else set()
+    missing = [task for task in tasks if task.id not in cached]
+    downloads = zip(missing, _iter_task_logs(run_id, missing, settings, options))
+
+    fetched = {}
+    position = 0
+    try:
+        for task, log in downloads:
+            # the cached logs of the tasks listed before the downloaded one
+            while tasks[position].id != task.id:
+                yield get_log(cache, run_id, tasks[position].id, tail_kb)
+                position += 1
+            position += 1
+
+            # the log of a task is final only once the task is completed
+            if cache and log is not None and task.state == 'completed':
+                fetched[task.id] = log
+            if fetched and (len(fetched) >= 100 or task is missing[-1]):
+                save_logs(cache, run_id, tail_kb, fetched)
+                fetched = {}
+            yield log if log is not None else 'Failed to retrieve the log.'
+
+        for task in tasks[position:]:
+            yield get_log(cache, run_id, task.id, tail_kb)
+    finally:
+        # the consumer stopped before the last downloaded log
+        if fetched:
+            save_logs(cache, run_id, tail_kb, fetched)
+
+
 def _parse_tests(task_lists: list):
+    from miriam._utility import parse_test_name
+
     for index, task in enumerate(task_lists):
         row = [index + 1]
 
-        _, test_method, test_class = task.display_name.split(' ')
-        test_class = test_class.strip('()')
-
-        parts = test_class.split('.')
-        class_name = parts[-1]
-        if test_class.startswith('azure.cli.command_modules.'):
-            row.append(parts[3].upper())
-        elif test_class.startswith('azure.cli.'):
-            row.append(parts[2].upper())
-        else:
-            raise ValueError('Unexpected test display name: {}'.format(task.display_name))
+        test_name = parse_test_name(task.display_name)
+        class_name = test_name.test_class.split('.')[-1]
+        row.append(test_name.module)
 
-        row.append(f'{test_method} ({class_name})')
-        row.append(task.execution_info.exit_code)
-        row.append((task.execution_info.end_time - task.execution_info.start_time).total_seconds())
+        info = task.execution_info
+        row.append(f'{test_name.method} ({class_name})')
+        row.append(info.exit_code if info else None)
+        row.append((info.end_time - info.start_time).total_seconds() if info and info.end_time else None)
 
         yield row
 
 
 def _report(args: argparse.Namespace) -> None:
-    import yaml
-    settings = yaml.load(args.config)
+    from miriam._utility import load_settings
+    from miriam.cache import open_cache
 
-    tasks_list = list(_query_results(settings, args.run_id, args.failed))
-    tasks_results = list(_parse_tests(tasks_list))
-
-    if args.include_log and args.html:
-        tasks_logs = list(_get_task_log(args.run_id, task, settings) for task in tasks_list)
-    else:
-        tasks_logs = list()
+    settings = load_settings(args.config)
+    cache = None if args.no_cache else open_cache(args.cache)
+    tasks = load_results(settings, args.run_id, cache, args.failed, args.state)
 
     headers = ['ID', 'Module', 'Test (Class)', 'Exit Code', 'Duration']
 
@@ -77,57 +314,42 @@ def _report(args: argparse.Namespace) -> None:
         headers.append('Log')
 
     if args.html:
-        with open('results.html', 'w') as html_file:
-            html_file.write(_build_html_page(args.run_id, headers, tasks_results, tasks_logs))
+        from miriam.html_report import ReportLogs, write_html_report
+
+        logs = None
+        if args.include_log:
+            tasks = list(tasks)
+            logs = ReportLogs(_load_task_logs(args.run_id, tasks, settings, cache,
+                                              LogOptions(workers=args.log_workers, tail_kb=args.log_tail)),
+                              log_dir='results_logs' if args.log_files else None)
+
+        write_html_report('results.html', args.run_id, headers, _parse_tests(tasks), logs)
     else:
         import tabulate
-        print(tabulate.tabulate(tasks_results, headers=headers))
-
-
-def _build_html_page(run_id: str, headers: list, test_results: list, test_logs: list) -> str:
-    import tabulate
-
-    results_log = ''
-    for idx, test_log in enumerate(test_logs):
-        test_name = test_results[idx][2]
-        results_log += f'<div class=\'row\'><h4 id={idx}>{test_name}</h4><pre><code>{test_log}</code></pre></div>'
-
-    if results_log:
-        for idx, test_result in enumerate(test_results):
-            test_result.append(f'<a href="#{idx}">Log</a>')
-    results_table = tabulate.tabulate(test_results, headers=headers, tablefmt='html')
-
-    return """
-<html>
-<head>
-<title>Test results {0}</title>
-<link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css" integrity="sha384-BVYiiSIFeK1dGmJRAkycuHAHRg32OmUcww7on3RYdg4Va+PmSTsz/K68vbdEjh4u" crossorigin="anonymous">
-</head>
-<body>
-<div class='container'>
-<div class='row'>
-<h1>Azure CLI Automation Result</h1>
-<dl class="dl-horizontal">
-  <dt>Run ID</dt>
-  <dd>{0}</dd>
-</dl>
-</div>
-<div class='row'>
-{1}
-</div>
-{2}
-</div>
-</body>
-</html>
-""".format(run_id, results_table, results_log).replace('<table>', '<table class="table table-condensed table-striped">')
+        print(tabulate.tabulate(list(_parse_tests(tasks)), headers=headers))
 
 
 def setup(subparsers) -> None:
+    from miriam.cache import DEFAULT_CACHE_PATH
+
     parser = subparsers.add_parser('report', help='Report the results of a test job.')
     parser.add_argument('run_id', help='The test run id from which the results are collected.')
 
     parser.add_argument('--html', action='store_true', help='Output the result in an HTML page.')
     parser.add_argument('--failed', action='store_true', help='List the failed tests only.')
+    parser.add_argument('--state', choices=['active', 'preparing', 'running', 'completed'],
+                        help='List the tests in the given state only.')
     parser.add_argument('--include-log', action='store_true',
                         help='List the url to the log blob. Only works with HTML output')
+    parser.add_argument('--log-files', action='store_true',
+                        help='Save each log in its own file under results_logs, opened from the page on demand, '
+                             'instead of inline in the page.')
+    parser.add_argument('--log-workers', type=int, default=8,
+                        help='The number of logs downloaded concurrently when --include-log is set. Default: 8')
+    parser.add_argument('--log-tail', type=int, default=0, metavar='KB',
+                        help='Only download the last KB kilobytes of each log. Default: 0, the whole log.')
+    parser.add_argument('--cache', metavar='PATH',
+                        help=f'The path of the local results cache. Default: {DEFAULT_CACHE_PATH}')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Query the Batch service for all the results and skip the local results cache.')
     parser.set_defaults(func=_report)
@@ -0,0 +1,191 @@
+"""
+A rerun schedules the tests failed in a test run again, in a job of their own named '<run id>-rerun<n>'.
+
+The rerun job runs on the pool of the original job and installs the same build with a preparation task of its own, so
+that the SAS of the build resource files are valid again. Its tasks are clones of the failed tasks writing their output
+to the output container of the rerun job. The report of the original run merges the results of its shards and reruns,
+the latest attempt of a test taking precedence, and refers to the tasks of these jobs as '<job id>/<task id>'.
+"""
+
+import argparse
+import re
+
+
+def _get_build_id(job) -> str:
+    """ The build tested by a job, recorded in its metadata or, for the jobs created before, in its display name. """
+    build_id = next((item.value for item in job.metadata or [] if item.name == 'build'), None)
+    if not build_id:
+        match = re.search(r'Automation on build (\S+)\. Live:', job.display_name or '')
+        build_id = match.group(1) if match else None
+    return build_id
+
+
+def _get_node_cache_mb(job) -> int:
+    """ The size of the node cache the preparation task of a job installs the build through, 0 if it doesn't. """
+    settings = job.job_preparation_task.environment_settings if job.job_preparation_task else None
+    return next((int(setting.value) for setting in settings or [] if setting.name == 'MIRIAM_CACHE_MAX_MB'), 0)
+
+
+def _list_tasks(batch_client, job_id: str, task_ids: list) -> dict:
+    """ Get the given tasks of a job, listing them by chunks of ids instead of getting them one by one. """
+    from azure.batch.models import TaskListOptions
+
+    tasks = {}
+    for start in range(0, len(task_ids), 50):
+        ids = ' or '.join(f"id eq '{task_id}'" for task_id in task_ids[start:start + 50])
+        tasks.update((task.id, task) for task in batch_client.task.list(
+            job_id, task_list_options=TaskListOptions(filter=f'({ids})')))
+    return tasks
+
+
+def _create_rerun_tasks(batch_client, run_id: str, failed: list, output_container_url: str) -> list:
+    """
+    Clone the definitions of the failed tasks. The failed tests of a bundle are run again in a bundle of the same id
+    made of these tests only. The failed tests of the bundles of the same id in different jobs of the run, such as a
+    bundle and its own rerun, are run in one bundle.
+    """
+    from collections import OrderedDict
+    from miriam._utility import get_logger
+    from miriam.bundle import create_bundle_task, parse_bundle_tests
+    from miriam.jobs import split_attempt_id, clone_task
+
+    singles = []
+    bundles = OrderedDict()
+    for record in failed:
+        job_id, task_id = split_attempt_id(run_id, record.id)
+        if '/' in task_id:
+            bundles.setdefault((job_id, task_id.split('/')[0]), set()).add(record.display_name)
+        else:
+            singles.append((job_id, task_id))
+
+    task_ids = OrderedDict()
+    for job_id, task_id in singles + list(bundles):
+        task_ids.setdefault(job_id, []).append(task_id)
+    found = dict(((job_id, task.id), task) for job_id, ids in task_ids.items()
+                 for task in _list_tasks(batch_client, job_id, ids).values())
+
+    missing = [f'{job_id}/{task_id}' for job_id, task_id in singles + list(bundles) if (job_id, task_id) not in found]
+    if missing:
+        get_logger('rerun').warning('The tasks %s are not found and are not run again.', ', '.join(missing))
+
+    merged = OrderedDict()
+    for key, names in bundles.items():
+        if key in found:
+            merged.setdefault(key[1], []).extend(test for test in parse_bundle_tests(found[key]) if test[0] in names)
+
+    tasks = [clone_task(found[key], output_container_url) for key in singles if key in found]
+    tasks.extend(create_bundle_task(bundle_id, tests, output_container_url) for bundle_id, tests in merged.items())
+    return tasks
+
+
+def _create_rerun_job(settings: dict, job, attempt: int) -> tuple:
+    """
+    Create the definition of the given rerun of a job, along with its output container. Returns the definition and the
+    url of the output container, or None if the build tested by the job is not found. The job is left active once its
+    tasks complete, until it is patched to terminate once its tasks are added.
+    """
+    from azure.batch.models import JobAddParameter, EnvironmentSetting, MetadataItem, OnAllTasksComplete
+    from miriam._utility import create_storage_client, get_logger
+    from miriam.jobs import get_rerun_id
+    from miriam.node_cache import create_cached_release_task
+    from miriam.schedule_test import _create_output_container_folder, _create_prep_task
+
+    build_id = _get_build_id(job)
+    if not build_id:
+        get_logger('rerun').error('The build tested by job %s is not found.', job.id)
+        return None
+
+    rerun_id = get_rerun_id(job.id, attempt)
+    node_cache_mb = _get_node_cache_mb(job)
+    storage_client = create_storage_client(settings)
+    prep_task = _create_prep_task(storage_client, build_id, node_cache_mb)
+    output_container_url = _create_output_container_folder(storage_client, rerun_id)
+
+    environment = [setting for setting in job.common_environment_settings or []
+                   if setting.name != 'AUTOMATION_OUTPUT_CONTAINER']
+    environment.append(EnvironmentSetting(name='AUTOMATION_OUTPUT_CONTAINER', value=output_container_url))
+
+    return JobAddParameter(
+        id=rerun_id,
+        pool_info=job.pool_info,
+        display_name=f'Rerun {attempt} of {job.id}. {job.display_name}',
+        common_environment_settings=environment,
+        job_preparation_task=prep_task,
+        job_release_task=create_cached_release_task(build_id) if node_cache_mb else None,
+        metadata=(job.metadata or []) + [MetadataItem('rerun-of', job.id)],
+        on_all_tasks_complete=OnAllTasksComplete.no_action), output_container_url
+
+
+def rerun_failed(settings: dict, run_id: str, max_attempts: int = 3, cache=None) -> str:
+    """
+    Schedule the tests whose latest attempt failed in a new rerun job. Returns the id of the rerun job, or None if
+    no test failed or the tests were attempted max_attempts times already.
+    """
+    from azure.batch.models import JobPatchParameter, OnAllTasksComplete
+    from miriam._utility import create_batch_client, get_logger
+    from miriam.cache import get_run, save_run_jobs
+    from miriam.jobs import list_reruns
+    from miriam.report import load_results
+    from miriam.submit import submit_tasks
+
+    logger = get_logger('rerun')
+    batch_client = create_batch_client(settings)
+
+    reruns = list_reruns(settings, run_id)
+    if len(reruns) + 1 >= max_attempts:
+        logger.error('The tests of run %s were attempted %d times already.', run_id, len(reruns) + 1)
+        return None
+
+    failed = list(load_results(settings, run_id, cache, failed_only=True, state='completed'))
+    if not failed:
+        logger.info('No test failed in run %s.', run_id)
+        return None
+
+    rerun_job = _create_rerun_job(settings, batch_client.job.get(run_id), len(reruns) + 1)
+    if not rerun_job:
+        return None
+
+    rerun_job, output_container_url = rerun_job
+    rerun_id = rerun_job.id
+    tasks = _create_rerun_tasks(batch_client, run_id, failed, output_container_url)
+    batch_client.job.add(rerun_job)
+
+    rejected = submit_tasks(batch_client, rerun_id, tasks)
+    if rejected:
+        logger.error('Failed to add the tasks %s to job %s.', ', '.join(task.id for task in rejected), rerun_id)
+
+    # a job without tasks has all its tasks complete, so it may only terminate once they are added
+    batch_client.job.patch(rerun_id, JobPatchParameter(on_all_tasks_complete=OnAllTasksComplete.terminate_job))
+
+    run = get_run(cache, run_id) if cache is not None else None
+    if run and run.jobs is not None:
+        save_run_jobs(cache, run_id, run.jobs + [rerun_id])
+
+    logger.info('Job %s is created to rerun %d failed tests in %d tasks.', rerun_id, len(failed), len(tasks))
+    return rerun_id
+
+
+def _rerun(args: argparse.Namespace) -> None:
+    import sys
+    from miriam._utility import load_settings
+    from miriam.cache import open_cache
+
+    settings = load_settings(args.config)
+    rerun_id = rerun_failed(settings, args.run_id, args.max_attempts, None if args.no_cache else open_cache(args.cache))
+    if not rerun_id:
+        sys.exit(1)
+    print(rerun_id)
+
+
+def setup(subparsers) -> None:
+    from miriam.cache import DEFAULT_CACHE_PATH
+
+    parser = subparsers.add_parser('rerun', help='Run the failed tests of a test job again.')
+    parser.add_argument('run_id', help='The test run id whose failed tests are run again.')
+    parser.add_argument('--max-attempts', type=int, default=3, metavar='N',
+                        help='The number of times a test may be attempted, the original run included. Default: 3')
+    parser.add_argument('--cache', metavar='PATH',
+                        help=f'The path of the local results cache. Default: {DEFAULT_CACHE_PATH}')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Query the Batch service for all the results and skip the local results cache.')
+    parser.set_defaults(func=_rerun)
@@ -1,7 +1,13 @@
 import argparse
 
-from azure.batch import BatchServiceClient
-from azure.storage.blob import BlockBlobService
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from azure.batch import BatchServiceClient
+    from azure.storage.blob import BlockBlobService
+
+BUILD_ARCHIVE = 'artifacts.tar.gz'
+BUILD_MANIFEST = 'manifest.txt'
 
 
 def generate_build_id():
@@ -11,22 +17,95 @@ def generate_build_id():
     return 'build-{}'.format(timestamp)
 
 
-def get_build_blob_container_url(storage_client: BlockBlobService):
-    from datetime import datetime, timedelta
+def get_build_blob_container_url(storage_client: 'BlockBlobService'):
     from azure.storage.blob import ContainerPermissions
+    from miriam._utility import get_container_sas
 
     storage_client.create_container('builds', fail_on_exist=False)
     return storage_client.make_blob_url(
         container_name='builds',
         blob_name='',
         protocol='https',
-        sas_token=storage_client.generate_container_shared_access_signature(
-            container_name='builds',
-            permission=ContainerPermissions(list=True, write=True),
-            expiry=(datetime.utcnow() + timedelta(days=1))))
+        sas_token=get_container_sas(storage_client, 'builds', ContainerPermissions(list=True, write=True)))
+
+
+def resolve_commit(url: str, branch: str) -> str:
+    """ Resolve the commit SHA the branch of the remote git repository points to. """
+    import subprocess
+
+    # a bare branch name would also match the tags and the branches ending in /<branch>
+    ref = f'refs/heads/{branch}'
+    output = subprocess.check_output(['git', 'ls-remote', '--', url, ref], universal_newlines=True)
+    commits = [line.split()[0] for line in output.splitlines() if line.split()[1:] == [ref]]
+    if len(commits) != 1:
+        raise ValueError(f'Branch {branch} is not found in {url}.')
+    return commits[0]
 
 
-def _create_build_job(batch_client: BatchServiceClient, storage_client: BlockBlobService, settings: dict):
+def find_build(batch_client: 'BatchServiceClient', storage_client: 'BlockBlobService', commit: str,
+               archive: bool = False) -> str:
+    """
+    Look up the build of the given commit in the builds container. A build is reused if its artifacts are uploaded the
+    same way, as an archive or not, and its build task succeeded or is still in progress. If the build job is gone, the
+    build is reused as long as its artifacts exist.
+    """
+    from azure.common import AzureMissingResourceHttpError
+    from azure.batch.models import BatchErrorException, TaskGetOptions, TaskState
+
+    try:
+        metadata = storage_client.get_blob_metadata('builds', f'commits/{commit}')
+    except AzureMissingResourceHttpError:
+        return None
+    # the builds recorded before the archives were introduced uploaded their files
+    build_id = metadata.get('build_id')
+    if not build_id or metadata.get('artifacts', 'files') != ('archive' if archive else 'files'):
+        return None
+
+    try:
+        task = batch_client.task.get(build_id, 'build',
+                                     task_get_options=TaskGetOptions(select='id,state,executionInfo'))
+        if task.state != TaskState.completed:
+            return build_id
+        return build_id if task.execution_info.exit_code == 0 else None
+    except BatchErrorException:
+        return build_id if any(storage_client.list_blobs('builds', prefix=f'{build_id}/', num_results=1)) else None
+
+
+def _create_build_task(settings: dict, commit: str, build_id: str, build_container_url: str, archive: bool = False):
+    """ Create the task building the given commit and uploading its artifacts to the build container. """
+    from azure.batch.models import (TaskAddParameter, OutputFile, OutputFileDestination, OutputFileUploadOptions,
+                                    OutputFileUploadCondition, OutputFileBlobContainerDestination)
+    from miriam._utility import get_command_string
+
+    remote_gitsrc_dir = 'gitsrc'
+    build_commands = [
+        'git clone -b {} -- {} gitsrc'.format(settings['gitsource']['branch'], settings['gitsource']['url']),
+        f'pushd {remote_gitsrc_dir}',
+        f'git checkout {commit}',
+        './scripts/batch/build_all.sh'
+    ]
+
+    def _output_file(pattern: str, path: str) -> OutputFile:
+        return OutputFile(f'{remote_gitsrc_dir}/{pattern}',
+                          OutputFileDestination(OutputFileBlobContainerDestination(build_container_url, path)),
+                          OutputFileUploadOptions(OutputFileUploadCondition.task_success))
+
+    if archive:
+        build_commands.append(f'tar -czf {BUILD_ARCHIVE} -C artifacts .')
+        build_commands.append(f'(cd artifacts && find . -type f -exec sha256sum {{}} +) > {BUILD_MANIFEST}')
+        output_files = [_output_file(BUILD_ARCHIVE, f'{build_id}/{BUILD_ARCHIVE}'),
+                        _output_file(BUILD_MANIFEST, f'{build_id}/{BUILD_MANIFEST}')]
+    else:
+        output_files = [_output_file('artifacts/**/*.*', build_id)]
+
+    return TaskAddParameter(id='build',
+                            command_line=get_command_string(*build_commands),
+                            display_name='Build all product and test code.',
+                            output_files=output_files)
+
+
+def _create_build_job(batch_client: 'BatchServiceClient', storage_client: 'BlockBlobService', settings: dict,
+                      force: bool = False, archive: bool = False):
     """
     Schedule a build job in the given pool. returns the container for build output and job reference.
 
@@ -34,15 +113,27 @@ def _create_build_job(batch_client: BatchServiceClient, storage_client: BlockBlo
     prepare test environment. The product and test build is an essential part of the preparation. The jobs can't be
     combined because the preparation task has to be defined by the time the job is created. However neither the product
     or the test package is ready then.
+
+    The build is keyed by the commit the branch points to. Unless force is set, the existing build of the same commit
+    is returned instead of scheduling a new one.
+
+    If archive is set, the artifacts are uploaded as one compressed archive along with a manifest of their checksums
+    instead of one blob per file.
     """
     import sys
-    from azure.batch.models import (TaskAddParameter, JobAddParameter, PoolInformation, OutputFile,
-                                    OutputFileDestination, OutputFileUploadOptions, OutputFileUploadCondition,
-                                    OutputFileBlobContainerDestination, OnAllTasksComplete)
-    from miriam._utility import get_command_string, get_logger
+    from azure.batch.models import JobAddParameter, PoolInformation, OnAllTasksComplete, MetadataItem
+    from miriam._utility import get_logger
 
-    remote_gitsrc_dir = 'gitsrc'
     logger = get_logger('build')
+
+    commit = resolve_commit(settings['gitsource']['url'], settings['gitsource']['branch'])
+    build_container_url = get_build_blob_container_url(storage_client)
+    if not force:
+        existing_build_id = find_build(batch_client, storage_client, commit, archive)
+        if existing_build_id:
+            logger.info('Commit %s is already built in %s.', commit, existing_build_id)
+            return existing_build_id
+
     build_id = generate_build_id()
     pool = batch_client.pool.get(next(p['id'] for p in settings['pools'] if p['usage'] == 'build'))
     if not pool:
@@ -52,42 +143,36 @@ def _create_build_job(batch_client: BatchServiceClient, storage_client: BlockBlo
     logger.info('Creating build job %s in pool %s', build_id, pool.id)
     batch_client.job.add(JobAddParameter(id=build_id,
                                          pool_info=PoolInformation(pool.id),
-                                         on_all_tasks_complete=OnAllTasksComplete.terminate_job))
+                                         on_all_tasks_complete=OnAllTasksComplete.terminate_job,
+                                         metadata=[MetadataItem('commit', commit),
+                                                   MetadataItem('branch', settings['gitsource']['branch'])]))
     logger.info('Job %s is created.', build_id)
 
-    build_commands = [
-        'git clone -b {} -- {} gitsrc'.format(settings['gitsource']['branch'], settings['gitsource']['url']),
-        f'pushd {remote_gitsrc_dir}',
-        './scripts/batch/build_all.sh'
-    ]
-
-    build_container_url = get_build_blob_container_url(storage_client)
-
-    output_file = OutputFile(f'{remote_gitsrc_dir}/artifacts/**/*.*',
-                             OutputFileDestination(OutputFileBlobContainerDestination(build_container_url, build_id)),
-                             OutputFileUploadOptions(OutputFileUploadCondition.task_success))
-
-    build_task = TaskAddParameter(id='build',
-                                  command_line=get_command_string(*build_commands),
-                                  display_name='Build all product and test code.',
-                                  output_files=[output_file])
+    build_task = _create_build_task(settings, commit, build_id, build_container_url, archive)
 
     batch_client.task.add(build_id, build_task)
     logger.info('Build task is added to job %s', build_id)
 
+    storage_client.create_blob_from_text('builds', f'commits/{commit}', build_id,
+                                         metadata={'build_id': build_id, 'commit': commit,
+                                                   'branch': settings['gitsource']['branch'],
+                                                   'artifacts': 'archive' if archive else 'files'})
+    logger.info('Build %s is recorded for commit %s.', build_id, commit)
+
     return build_id
 
 
 def build_entry(arg: argparse.Namespace) -> None:
-    import yaml
-    from miriam._utility import create_storage_client, create_batch_client, get_logger
+    from miriam._utility import create_storage_client, create_batch_client, get_logger, load_settings
 
-    settings = yaml.load(arg.config)
+    settings = load_settings(arg.config)
     logger = get_logger('build')
 
     build_job_id = _create_build_job(create_batch_client(settings),
                                      create_storage_client(settings),
-                                     settings)
+                                     settings,
+                                     force=arg.force,
+                                     archive=arg.archive)
 
     logger.info('Build job {} is scheduled. The results will be saved to container builds.'.format(build_job_id))
 
@@ -96,4 +181,8 @@ def build_entry(arg: argparse.Namespace) -> None:
 
 def setup(subparsers) -> None:
     parser = subparsers.add_parser('build', help='Start a build job')
+    parser.add_argument('--force', action='store_true',
+                        help='Build even if a build of the same commit already exists.')
+    parser.add_argument('--archive', action='store_true',
+                        help='Save the build as one compressed archive instead of one blob per file.')
     parser.set_defaults(func=build_entry)
@@ -1,10 +1,20 @@
 import argparse
-from datetime import datetime, timedelta
-from azure.storage.blob import BlockBlobService
-from miriam._utility import get_logger, get_command_string, create_batch_client, create_storage_client
+from collections import namedtuple
+from datetime import datetime
+from typing import TYPE_CHECKING
+from miriam._utility import (get_logger, get_command_string, create_batch_client, create_storage_client,
+                             get_container_sas, get_blob_sas, load_settings)
 
+if TYPE_CHECKING:
+    from azure.storage.blob import BlockBlobService
 
-def _list_build_resource_files(storage_client: BlockBlobService, build_id: str):
+# The options of a test run. plans holds the test plan of every test pool. If modules are given, only the tests of
+# these modules run. If node_cache_mb is set, the builds are installed through a cache of that size on every node.
+TestRunOptions = namedtuple('TestRunOptions', ['remain_active', 'run_live', 'plans', 'modules', 'node_cache_mb'])
+TestRunOptions.__new__.__defaults__ = (False, False, None, None, 0)
+
+
+def _list_build_resource_files(storage_client: 'BlockBlobService', build_id: str):
     """ List the files belongs to the target build in the build blob container """
     import sys
     from azure.storage.blob.models import ContainerPermissions
@@ -16,9 +26,7 @@ def _list_build_resource_files(storage_client: BlockBlobService, build_id: str):
         logger.error('The build container %s is not found.', 'builds')
         sys.exit(2)
 
-    sas = storage_client.generate_container_shared_access_signature(container_name='builds',
-                                                                    permission=ContainerPermissions(read=True),
-                                                                    expiry=(datetime.utcnow() + timedelta(days=1)))
+    sas = get_container_sas(storage_client, 'builds', ContainerPermissions(read=True))
     logger.info('Container %s is found and read only SAS token is generated.', 'builds')
 
     resource_files = []
@@ -34,7 +42,27 @@ def _list_build_resource_files(storage_client: BlockBlobService, build_id: str):
     return resource_files
 
 
-def _create_output_container_folder(storage_client: BlockBlobService, job_id: str):
+def _get_build_archive(storage_client: 'BlockBlobService', build_id: str):
+    """ Returns the resource files of the build archive and its manifest, or None if the build is not archived. """
+    from azure.storage.blob.models import BlobPermissions
+    from azure.batch.models import ResourceFile
+    from miriam.schedule_build import BUILD_ARCHIVE, BUILD_MANIFEST
+
+    if not storage_client.exists('builds', f'{build_id}/{BUILD_ARCHIVE}'):
+        return None
+
+    resource_files = []
+    for file_name in (BUILD_ARCHIVE, BUILD_MANIFEST):
+        blob_name = f'{build_id}/{file_name}'
+        sas = get_blob_sas(storage_client, 'builds', blob_name, BlobPermissions(read=True))
+        resource_files.append(ResourceFile(blob_source=storage_client.make_blob_url('builds', blob_name, 'https', sas),
+                                           file_path=file_name))
+
+    get_logger('test').info('Build %s is archived. The nodes download one archive.', build_id)
+    return resource_files
+
+
+def _create_output_container_folder(storage_client: 'BlockBlobService', job_id: str):
     """ Create output storage container """
     from azure.storage.blob.models import ContainerPermissions
 
@@ -45,64 +73,185 @@ def _create_output_container_folder(storage_client: BlockBlobService, job_id: st
         container_name=output_container_name,
         blob_name='',
         protocol='https',
-        sas_token=storage_client.generate_container_shared_access_signature(
-            container_name=output_container_name,
-            permission=ContainerPermissions(list=True, write=True),
-            expiry=(datetime.utcnow() + timedelta(days=1))))
+        sas_token=get_container_sas(storage_client, output_container_name, ContainerPermissions(list=True, write=True)))
 
 
-def create_test_job(build_id: str, settings: dict, remain_active: bool = False, run_live: bool = False):
-    from azure.batch.models import (JobPreparationTask, JobAddParameter, JobManagerTask, OnAllTasksComplete,
-                                    PoolInformation, EnvironmentSetting)
+def _create_prep_task(storage_client: 'BlockBlobService', build_id: str, node_cache_mb: int = 0):
+    """
+    Create the job preparation task installing the build. The SAS of its resource files are issued now, so a job
+    created later than their expiry, such as a rerun, needs a preparation task of its own.
+    """
+    from azure.batch.models import JobPreparationTask
+    from miriam.schedule_build import BUILD_ARCHIVE, BUILD_MANIFEST
+    from miriam.node_cache import create_cached_prep_task
 
-    logger = get_logger('test')
-    batch_client = create_batch_client(settings)
-    storage_client = create_storage_client(settings)
+    archive_files = _get_build_archive(storage_client, build_id)
+    if archive_files:
+        resource_files = archive_files
+        prep_commands = [f'tar -xzf {BUILD_ARCHIVE}', f'sha256sum --check --quiet {BUILD_MANIFEST}',
+                         f'rm {BUILD_ARCHIVE}', './app/install.sh']
+    else:
+        resource_files = _list_build_resource_files(storage_client, build_id)
+        prep_commands = ['./app/install.sh']
 
-    # create automation job
-    resource_files = _list_build_resource_files(storage_client, build_id)
+    if node_cache_mb:
+        return create_cached_prep_task(build_id, node_cache_mb, archive_files=archive_files,
+                                       resource_files=resource_files)
+    return JobPreparationTask(get_command_string(*prep_commands),
+                              resource_files=resource_files,
+                              wait_for_success=True)
 
-    prep_task = JobPreparationTask(get_command_string('./app/install.sh'),
-                                   resource_files=resource_files,
-                                   wait_for_success=True)
+
+def _create_manager_task(settings: dict):
+    """ Create the job manager task, which adds the test tasks of its job. """
+    from azure.batch.models import JobManagerTask, EnvironmentSetting
 
     env_settings = [EnvironmentSetting(name='AZURE_BATCH_KEY', value=settings['azurebatch']['key']),
                     EnvironmentSetting(name='AZURE_BATCH_ENDPOINT', value=settings['azurebatch']['endpoint'])]
 
-    manage_task = JobManagerTask('test-creator',
-                                 get_command_string('$AZ_BATCH_NODE_SHARED_DIR/app/schedule.sh'),
-                                 'Automation tasks creator',
-                                 kill_job_on_completion=False,
-                                 environment_settings=env_settings)
+    return JobManagerTask('test-creator',
+                          get_command_string('$AZ_BATCH_NODE_SHARED_DIR/app/schedule.sh'),
+                          'Automation tasks creator',
+                          kill_job_on_completion=False,
+                          environment_settings=env_settings)
+
 
-    job_id = 'test-{}'.format(datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
+def _create_job_environment(storage_client: 'BlockBlobService', settings: dict, options: TestRunOptions, job_id: str,
+                            shard: tuple) -> list:
+    """
+    Create the output container and the environment of the job of a shard. shard is the index of the shard and the
+    task slots of every shard.
+    """
+    from azure.batch.models import EnvironmentSetting
+    from miriam.scheduling import upload_plan
 
+    index, weights = shard
     output_container_url = _create_output_container_folder(storage_client, job_id)
 
     job_environment = [EnvironmentSetting(name='AUTOMATION_OUTPUT_CONTAINER', value=output_container_url)]
-    if run_live:
+    if options.modules is not None:
+        job_environment.append(EnvironmentSetting(name='AUTOMATION_TEST_MODULES',
+                                                  value=','.join(sorted(options.modules))))
+    if len(weights) > 1:
+        job_environment.append(EnvironmentSetting(name='AUTOMATION_TEST_SHARD', value=f'{index}/{len(weights)}'))
+        job_environment.append(EnvironmentSetting(name='AUTOMATION_TEST_SHARD_WEIGHTS',
+                                                  value=','.join(str(weight) for weight in weights)))
+    if options.run_live:
         job_environment.append(EnvironmentSetting(name='AZURE_TEST_RUN_LIVE', value='True'))
         job_environment.append(EnvironmentSetting(name='AUTOMATION_SP_NAME', value=settings['automation']['account']))
         job_environment.append(EnvironmentSetting(name='AUTOMATION_SP_PASSWORD', value=settings['automation']['key']))
         job_environment.append(EnvironmentSetting(name='AUTOMATION_SP_TENANT', value=settings['automation']['tenant']))
+    if options.plans:
+        plan = options.plans[index]
+        plan_url = upload_plan(storage_client, 'output-{}'.format(job_id), plan)
+        job_environment.append(EnvironmentSetting(name='AUTOMATION_TEST_PLAN', value=plan_url))
+        get_logger('test').info('Test plan of %d tasks, %d of them bundles, over %d slots is uploaded to job %s. '
+                                'Estimated makespan: %.0f seconds.', len(plan['order']), len(plan['bundles']),
+                                plan['slots'], job_id, plan['makespan'])
+    return job_environment
+
+
+def create_test_job(build_id: str, settings: dict, options: TestRunOptions = None) -> str:
+    """
+    Create the jobs of a test run, one per test pool. The jobs share the preparation and the manager tasks and every
+    job manager runs the share of the tests of its pool. Returns the run id.
+    """
+    import sys
+    from azure.batch.models import JobAddParameter, OnAllTasksComplete, PoolInformation, MetadataItem
+    from miriam.scheduling import get_pool_slots
+    from miriam.jobs import get_shard_id
+    from miriam.node_cache import create_cached_release_task
+    from miriam.sharding import get_test_pools
+
+    logger = get_logger('test')
+    options = options or TestRunOptions()
+    pools = get_test_pools(settings)
+    if not pools:
+        logger.error('No pool with usage test has a task slot.')
+        sys.exit(2)
+
+    batch_client = create_batch_client(settings)
+    storage_client = create_storage_client(settings)
 
     # create automation job
-    batch_client.job.add(JobAddParameter(
-        id=job_id,
-        pool_info=PoolInformation(next(p['id'] for p in settings['pools'] if p['usage'] == 'test')),
-        display_name='Automation on build {}. Live: {}'.format(build_id, run_live),
-        common_environment_settings=job_environment,
-        job_preparation_task=prep_task,
-        job_manager_task=manage_task,
-        on_all_tasks_complete=OnAllTasksComplete.no_action if remain_active else OnAllTasksComplete.terminate_job))
+    prep_task = _create_prep_task(storage_client, build_id, options.node_cache_mb)
+
+    manage_task = _create_manager_task(settings)
+
+    run_id = 'test-{}'.format(datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
+
+    weights = [get_pool_slots(pool) for pool in pools]
+    on_complete = OnAllTasksComplete.no_action if options.remain_active else OnAllTasksComplete.terminate_job
+
+    for index, pool in enumerate(pools):
+        job_id = get_shard_id(run_id, index)
+        job_environment = _create_job_environment(storage_client, settings, options, job_id, (index, weights))
+
+        # create automation job
+        batch_client.job.add(JobAddParameter(
+            id=job_id,
+            pool_info=PoolInformation(pool['id']),
+            display_name='Automation on build {}. Live: {}'.format(build_id, options.run_live),
+            common_environment_settings=job_environment,
+            job_preparation_task=prep_task,
+            job_release_task=create_cached_release_task(build_id) if options.node_cache_mb else None,
+            job_manager_task=manage_task,
+            metadata=[MetadataItem('build', build_id)],
+            on_all_tasks_complete=on_complete))
+
+        logger.info('Job %s is created on pool %s with preparation task and manager task.', job_id, pool['id'])
+
+    return run_id
 
-    logger.info('Job %s is created with preparation task and manager task.', job_id)
+
+def _create_plan(settings: dict, cache_path: str = None, bundle_seconds: float = 0, modules: set = None):
+    """
+    Plan the test run based on the test durations recorded in the local results cache. Returns the plan of every test
+    pool.
+    """
+    from miriam.cache import open_cache
+    from miriam.impact import is_selected
+    from miriam.scheduling import estimate_durations, get_pool_slots
+    from miriam.sharding import create_shard_plans, get_test_pools
+
+    durations = dict((test, seconds) for test, seconds in estimate_durations(open_cache(cache_path)).items()
+                     if is_selected(test, modules))
+    if not durations:
+        get_logger('test').warning('No test duration is recorded. Run report on a previous run to record them.')
+        return None
+
+    weights = [get_pool_slots(pool) for pool in get_test_pools(settings)]
+    return create_shard_plans(durations, weights, bundle_seconds)
 
 
 def _test_entry(arg: argparse.Namespace) -> None:
-    import yaml
-    settings = yaml.load(arg.config)
-    create_test_job(arg.job_id, settings, remain_active=arg.remain_active, run_live=arg.live)
+    import sys
+    from subprocess import CalledProcessError
+    from miriam.impact import select_modules
+
+    logger = get_logger('test')
+    settings = load_settings(arg.config)
+    try:
+        modules = select_modules(settings, arg.job_id, arg.impact_baseline) if arg.impact_baseline else None
+    except ValueError as ex:
+        logger.error('%s Run the tests without --impact-baseline.', ex)
+        sys.exit(2)
+    except (CalledProcessError, OSError) as ex:
+        # git is missing, the mirror of the repository can't be updated or doesn't know one of the commits
+        logger.error('The changes since build %s are not found: %s Run the tests without --impact-baseline.',
+                     arg.impact_baseline, ex)
+        sys.exit(2)
+
+    if modules is not None and not modules:
+        logger.info('No test module is affected by the changes since build %s. No job is created.',
+                    arg.impact_baseline)
+        return
+
+    plans = _create_plan(settings, arg.cache, arg.bundle_seconds if arg.bundle else 0, modules) \
+        if arg.plan or arg.bundle else None
+    print(create_test_job(arg.job_id, settings, TestRunOptions(remain_active=arg.remain_active, run_live=arg.live,
+                                                               plans=plans, modules=modules,
+                                                               node_cache_mb=arg.node_cache)))
 
 
 def setup(subparsers) -> None:
@@ -110,4 +259,17 @@ def setup(subparsers) -> None:
     parser.add_argument('job_id', help='The ID of to build to test')
     parser.add_argument('--live', action='store_true', help='Run tests live')
     parser.add_argument('--remain-active', action='store_true', help='Keep the job active after all tasks are finished')
+    parser.add_argument('--plan', action='store_true',
+                        help='Hand the job manager a longest-first test plan based on the recorded test durations.')
+    parser.add_argument('--bundle', action='store_true',
+                        help='Run the short tests in bundles of many tests per task. Implies --plan.')
+    parser.add_argument('--bundle-seconds', type=float, default=60, metavar='SECONDS',
+                        help='The target duration of a bundle. Tests longer than it are not bundled. Default: 60')
+    parser.add_argument('--impact-baseline', metavar='BUILD_ID',
+                        help='Only run the tests of the modules changed since the commit of this build, and the '
+                             'modules configured to always run.')
+    parser.add_argument('--node-cache', type=int, default=0, metavar='MB',
+                        help='Keep the installed builds in a cache of up to MB megabytes on every node, so that the '
+                             'following jobs of the same build skip the installation. Default: 0, no cache.')
+    parser.add_argument('--cache', metavar='PATH', help='The path of the local results cache holding the durations.')
     parser.set_defaults(func=_test_entry)
@@ -0,0 +1,118 @@
+import heapq
+import sqlite3
+
+
+def record_durations(cache: sqlite3.Connection, run_id: str, tasks) -> None:
+    """ Record the durations of the finished test tasks in the duration history. """
+    from miriam._utility import parse_test_name
+    from miriam.cache import save_durations, to_utc
+
+    durations = []
+    for task in tasks:
+        info = task.execution_info
+        if not info or not info.start_time or not info.end_time:
+            continue
+        try:
+            test_name = parse_test_name(task.display_name)
+        except ValueError:
+            continue
+        durations.append((test_name.full_name, (to_utc(info.end_time) - to_utc(info.start_time)).total_seconds()))
+
+    save_durations(cache, run_id, durations)
+
+
+def estimate_durations(cache: sqlite3.Connection, history: int = 5) -> dict:
+    """ Estimate the duration of each known test as the median of its most recent runs. """
+    from miriam.cache import list_durations
+
+    estimates = {}
+    for test, samples in list_durations(cache, history).items():
+        samples = sorted(samples)
+        middle = len(samples) // 2
+        estimates[test] = samples[middle] if len(samples) % 2 else (samples[middle - 1] + samples[middle]) / 2
+    return estimates
+
+
+def get_pool_slots(pool_setting: dict) -> int:
+    """ The number of tasks the pool runs at the same time. An autoscale pool is counted at its max size. """
+    if pool_setting.get('autoscale'):
+        nodes = int(pool_setting['autoscale']['max'])
+    else:
+        nodes = int(pool_setting['dedicated']) + int(pool_setting['low-pri'])
+    return nodes * int(pool_setting['max-tasks'])
+
+
+def order_longest_first(durations: dict) -> list:
+    return sorted(durations, key=lambda test: (-durations[test], test))
+
+
+def pack(durations: dict, slots: int) -> tuple:
+    """
+    Distribute the tests to the given number of slots with the longest processing time first rule: every test, the
+    longest first, goes to the slot with the least work so far. Returns the estimated load and the tests of each slot.
+    """
+    heap = [(0.0, index) for index in range(slots)]
+    loads = [0.0] * slots
+    bins = [[] for _ in range(slots)]
+
+    for test in order_longest_first(durations):
+        load, index = heapq.heappop(heap)
+        loads[index] = load + durations[test]
+        bins[index].append(test)
+        heapq.heappush(heap, (loads[index], index))
+
+    return loads, bins
+
+
+def make_bundles(durations: dict, target_seconds: float, shard: int = 0) -> dict:
+    """
+    Group the tests shorter than the target duration into bundles of about the target duration. The bundles are
+    balanced with the same longest processing time first rule. Returns the tests of each bundle by the bundle id, which
+    holds the shard index so that the bundle ids are unique across the shards of a run.
+    """
+    import math
+    from miriam.bundle import get_bundle_id
+
+    short_tests = dict((test, seconds) for test, seconds in durations.items() if seconds < target_seconds)
+    if not short_tests:
+        return {}
+
+    _, bins = pack(short_tests, math.ceil(sum(short_tests.values()) / target_seconds))
+    return dict((get_bundle_id(index, shard), tests) for index, tests in enumerate(bins) if tests)
+
+
+def create_plan(durations: dict, slots: int, bundle_seconds: float = 0, shard: int = 0) -> dict:
+    """
+    Create the test plan handed to the job manager. The order lists the known tests, the longest first. The bins
+    split them among the slots of the pool. Tests absent from the history are not in the plan.
+
+    If bundle_seconds is set, the short tests are grouped into bundles which are ordered and packed as single units.
+    The plan of a shard beyond the first one names its bundles after the shard index.
+    """
+    units = dict(durations)
+    bundles = make_bundles(durations, bundle_seconds, shard) if bundle_seconds else {}
+    for bundle_id, tests in bundles.items():
+        units[bundle_id] = sum(units.pop(test) for test in tests)
+
+    loads, bins = pack(units, slots)
+    return {
+        'slots': slots,
+        'makespan': max(loads, default=0.0),
+        'order': order_longest_first(units),
+        'bins': bins,
+        'bundles': bundles
+    }
+
+
+def upload_plan(storage_client, container_name: str, plan: dict) -> str:
+    """ Save the plan as plan.json in the given container. Returns a read only url of the blob. """
+    import json
+    from azure.storage.blob.models import BlobPermissions
+    from miriam._utility import get_blob_sas
+
+    storage_client.create_blob_from_text(container_name, 'plan.json', json.dumps(plan))
+    return storage_client.make_blob_url(
+        container_name=container_name,
+        blob_name='plan.json',
+        protocol='https',
+        sas_token=get_blob_sas(storage_client, container_name, 'plan.json', BlobPermissions(read=True)))
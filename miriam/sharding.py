@@ -0,0 +1,69 @@
+"""
+A test run spreads over all the pools with usage 'test', one job per pool called a shard. The job of the first pool
+has the run id and the others are named '<run id>-shard<n>'. The report merges the results of the shards like the ones
+of the reruns.
+
+The job manager of a shard finds its part of the tests in two environment variables: AUTOMATION_TEST_SHARD holds
+'<index>/<count>' and AUTOMATION_TEST_SHARD_WEIGHTS the comma separated task slots of every shard. A test assigned to a
+shard in the 'assignments' of the test plan runs in that shard. The other tests are taken in the sorted order and the
+n-th one runs in the shard whose range of weights holds n modulo the sum of the weights, so that every pool receives
+work in proportion to its capacity.
+"""
+
+import heapq
+
+
+def get_test_pools(settings: dict) -> list:
+    """ The pools with usage 'test' which can run tasks. A pool configured with no task slot gets no shard. """
+    from miriam.scheduling import get_pool_slots
+    return [p for p in settings['pools'] if p['usage'] == 'test' and get_pool_slots(p) > 0]
+
+
+def split_tests(durations: dict, weights: list) -> list:
+    """
+    Split the tests among shards of the given capacities. Every test, the longest first, goes to the shard which would
+    finish it the earliest given the work assigned so far. Returns the durations of the tests of each shard.
+    """
+    from miriam.scheduling import order_longest_first
+
+    # a shard without capacity receives no test
+    heap = [(0.0, index) for index, weight in enumerate(weights) if weight > 0]
+    loads = [0.0] * len(weights)
+    shards = [{} for _ in weights]
+
+    for test in order_longest_first(durations):
+        _, index = heapq.heappop(heap)
+        loads[index] += durations[test]
+        shards[index][test] = durations[test]
+        heapq.heappush(heap, (loads[index] / weights[index], index))
+
+    return shards
+
+
+def create_shard_plans(durations: dict, weights: list, bundle_seconds: float = 0) -> list:
+    """ Create the test plan of every shard. The plans of a run over several pools tell which shard runs a test. """
+    from miriam.scheduling import create_plan
+
+    shards = split_tests(durations, weights)
+    plans = [create_plan(shard, weight, bundle_seconds, index)
+             for index, (shard, weight) in enumerate(zip(shards, weights))]
+    if len(plans) > 1:
+        assignments = dict((test, index) for index, shard in enumerate(shards) for test in shard)
+        for plan in plans:
+            plan['assignments'] = assignments
+    return plans
+
+
+def select_shard_tests(tests: list, index: int, weights: list, assignments: dict = None) -> list:
+    """
+    Select the tests run by a shard out of the (test name, ...) tuples of the whole suite, following the assignments
+    of the plan for the planned tests and the weights of the shards for the others.
+    """
+    assignments = assignments or {}
+    low = sum(weights[:index])
+    high = low + weights[index]
+
+    selected = [test for test in tests if assignments.get(test[0]) == index]
+    others = sorted((test for test in tests if test[0] not in assignments), key=lambda test: test[0])
+    selected.extend(test for position, test in enumerate(others) if low <= position % sum(weights) < high)
+    return selected
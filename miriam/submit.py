@@ -0,0 +1,214 @@
+"""
+Bulk submission of test tasks, meant to be called by the job manager of a test job.
+
+The tests are read from a file, one '<task id>\t<display name>\t<command line>' per line. They are filtered down to the
+modules selected by the test impact analysis and to the shard of the job, ordered and bundled according to the test
+plan, then added with add_collection in chunks of the largest size the service accepts, several chunks at a time. Only
+the tasks the service failed to add are retried. On a node, the Batch account is taken from the environment of the job
+so that no settings file is needed.
+"""
+
+import argparse
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from azure.batch import BatchServiceClient
+
+# The largest number of tasks add_collection accepts in one call.
+MAX_CHUNK_SIZE = 100
+
+
+def get_environment_settings() -> dict:
+    """ The settings of the Batch account found in the environment of the tasks of a test job. """
+    import os
+    return {'azurebatch': {'account': os.environ['AZ_BATCH_ACCOUNT_NAME'],
+                           'key': os.environ['AZURE_BATCH_KEY'],
+                           'endpoint': os.environ['AZURE_BATCH_ENDPOINT']}}
+
+
+def _add_chunk(batch_client: 'BatchServiceClient', job_id: str, chunk: list, lost: set) -> tuple:
+    """
+    Add a chunk of tasks. Returns the tasks to retry and the tasks which can't be added. The ids of the tasks whose
+    request failed to reach the service or to come back are added to lost: they may be added already.
+    """
+    from azure.batch.models import BatchErrorException, TaskAddStatus
+    from msrest.exceptions import ClientRequestError
+    from requests import RequestException
+    from miriam._utility import get_logger
+
+    logger = get_logger('submit')
+    try:
+        result = batch_client.task.add_collection(job_id, chunk)
+    except BatchErrorException as ex:
+        code = getattr(getattr(ex, 'error', None), 'code', None)
+        if code == 'RequestBodyTooLarge' and len(chunk) > 1:
+            middle = len(chunk) // 2
+            retries, failures = _add_chunk(batch_client, job_id, chunk[:middle], lost)
+            more_retries, more_failures = _add_chunk(batch_client, job_id, chunk[middle:], lost)
+            return retries + more_retries, failures + more_failures
+        logger.warning('Failed to add %d tasks to job %s: %s', len(chunk), job_id, ex)
+        return chunk, []
+    except (ClientRequestError, RequestException) as ex:
+        # the connection failed or was reset, some of the tasks may be added already
+        logger.warning('Failed to send %d tasks to job %s: %s', len(chunk), job_id, ex)
+        lost.update(task.id for task in chunk)
+        return chunk, []
+
+    tasks = dict((task.id, task) for task in chunk)
+    retries = []
+    failures = []
+    for item in result.value:
+        if item.status == TaskAddStatus.success:
+            continue
+        code = item.error.code if item.error else None
+        if code == 'TaskExists' and item.task_id in lost:
+            # added by an earlier attempt whose response was lost
+            continue
+        if item.status == TaskAddStatus.server_error:
+            retries.append(tasks[item.task_id])
+        else:
+            logger.error('Task %s is rejected: %s', item.task_id, item.error.message if item.error else code)
+            failures.append(tasks[item.task_id])
+    return retries, failures
+
+
+def submit_tasks(batch_client: 'BatchServiceClient', job_id: str, tasks: list, workers: int = 8,
+                 retries: int = 3) -> list:
+    """
+    Add the tasks to the job in chunks of MAX_CHUNK_SIZE, up to workers chunks at the same time. The tasks failed
+    because of the service are retried up to the given number of times with an exponential back off. Returns the tasks
+    which could not be added.
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from miriam._utility import get_logger
+
+    logger = get_logger('submit')
+    pending = list(tasks)
+    failures = []
+    lost = set()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(2 ** attempt)
+                logger.info('Retrying %d tasks of job %s.', len(pending), job_id)
+
+            chunks = [pending[start:start + MAX_CHUNK_SIZE] for start in range(0, len(pending), MAX_CHUNK_SIZE)]
+            pending = []
+            results = executor.map(lambda c: _add_chunk(batch_client, job_id, c, lost), chunks)
+            for chunk_retries, chunk_failures in results:
+                pending.extend(chunk_retries)
+                failures.extend(chunk_failures)
+            if not pending:
+                break
+
+    logger.info('%d tasks are added to job %s.', len(tasks) - len(pending) - len(failures), job_id)
+    return pending + failures
+
+
+def _get_plan_name(display_name: str) -> str:
+    """ The name of a test in the test plan. """
+    from miriam._utility import parse_test_name
+    try:
+        return parse_test_name(display_name).full_name
+    except ValueError:
+        return display_name
+
+
+def read_tests(lines) -> list:
+    """ Parse the '<task id>\t<display name>\t<command line>' lines of a test list. """
+    return [tuple(line.rstrip('\n').split('\t', 2)) for line in lines if line.count('\t') >= 2]
+
+
+def create_test_tasks(tests: list, output_container_url: str, plan: dict = None) -> list:
+    """
+    Create the tasks of the (task id, display name, command line) tests. With a plan, the tests it bundles are run in
+    bundle tasks and the tasks are ordered the longest first. The tests unknown to the plan come first since their
+    durations are unknown.
+    """
+    from azure.batch.models import (TaskAddParameter, OutputFile, OutputFileDestination, OutputFileUploadOptions,
+                                    OutputFileUploadCondition, OutputFileBlobContainerDestination)
+    from miriam.bundle import create_bundle_task
+
+    def _create_task(task_id: str, display_name: str, command_line: str) -> TaskAddParameter:
+        destination = OutputFileBlobContainerDestination(output_container_url, f'{task_id}/stdout.txt')
+        return TaskAddParameter(id=task_id, display_name=display_name, command_line=command_line,
+                                output_files=[OutputFile('../stdout.txt', OutputFileDestination(destination),
+                                                         OutputFileUploadOptions(
+                                                             OutputFileUploadCondition.task_completion))])
+
+    if not plan:
+        return [_create_task(*test) for test in tests]
+
+    by_name = dict((_get_plan_name(test[1]), test) for test in tests)
+    planned = set(plan['order']).union(name for names in plan['bundles'].values() for name in names)
+
+    tasks = [_create_task(*test) for name, test in by_name.items() if name not in planned]
+    for unit in plan['order']:
+        if unit in plan['bundles']:
+            bundle = [(by_name[name][1], by_name[name][2]) for name in plan['bundles'][unit] if name in by_name]
+            if bundle:
+                tasks.append(create_bundle_task(unit, bundle, output_container_url))
+        elif unit in by_name:
+            tasks.append(_create_task(*by_name[unit]))
+    return tasks
+
+
+def _load_plan(url: str) -> dict:
+    from miriam._utility import get_http_session
+
+    response = get_http_session().get(url, timeout=60)
+    response.raise_for_status()
+    return response.json()
+
+
+def _submit(args: argparse.Namespace) -> None:
+    import os
+    import sys
+    from miriam._utility import create_batch_client, load_settings
+    from miriam.impact import is_selected
+    from miriam.sharding import select_shard_tests
+
+    settings = load_settings(args.config) if args.config else get_environment_settings()
+    plan = _load_plan(args.plan) if args.plan else None
+
+    with open(args.tests, 'r') if args.tests != '-' else sys.stdin as tests_file:
+        tests = read_tests(tests_file)
+
+    if 'AUTOMATION_TEST_MODULES' in os.environ:
+        # an empty selection only keeps the tests whose module is unknown
+        modules = set(module for module in os.environ['AUTOMATION_TEST_MODULES'].split(',') if module)
+        tests = [test for test in tests if is_selected(_get_plan_name(test[1]), modules)]
+
+    shard = os.environ.get('AUTOMATION_TEST_SHARD')
+    if shard:
+        index = int(shard.split('/')[0])
+        weights = [int(weight) for weight in os.environ['AUTOMATION_TEST_SHARD_WEIGHTS'].split(',')]
+        named = select_shard_tests([(_get_plan_name(test[1]),) + test for test in tests], index, weights,
+                                   plan.get('assignments') if plan else None)
+        tests = [test[1:] for test in named]
+
+    tasks = create_test_tasks(tests, args.output_container, plan)
+    failed = submit_tasks(create_batch_client(settings), args.job_id, tasks, args.workers, args.retries)
+    if failed:
+        print('Failed to add tasks: ' + ', '.join(task.id for task in failed), file=sys.stderr)
+        sys.exit(1)
+
+
+def setup(subparsers) -> None:
+    import os
+
+    parser = subparsers.add_parser('submit-tasks', help='Add the test tasks to a test job in bulk.')
+    parser.add_argument('tests', help='The file listing the tests, one "<task id>\\t<display name>\\t<command line>" '
+                                      'per line. "-" reads the standard input.')
+    parser.add_argument('--job-id', default=os.environ.get('AZ_BATCH_JOB_ID'),
+                        help='The test job. Default: the job of the current task.')
+    parser.add_argument('--output-container', default=os.environ.get('AUTOMATION_OUTPUT_CONTAINER'),
+                        help='The url of the output container. Default: the one of the current job.')
+    parser.add_argument('--plan', default=os.environ.get('AUTOMATION_TEST_PLAN'),
+                        help='The url of the test plan. Default: the one of the current job, if any.')
+    parser.add_argument('--workers', type=int, default=8, help='The number of chunks added at a time. Default: 8')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='The number of times the tasks failed because of the service are retried. Default: 3')
+    parser.set_defaults(func=_submit)
@@ -0,0 +1,220 @@
+"""
+The timing of a test run broken down by phase: the start task of the nodes, the job preparation task (the download of
+the build and install.sh), the wait of the tasks in the queue, and their execution. The execution of a task includes
+the upload of its output files, which the Batch service doesn't time separately.
+"""
+
+import argparse
+import math
+from bisect import bisect_right
+from collections import namedtuple
+
+# A phase of the run on a node. The times are seconds since the creation of the run.
+Interval = namedtuple('Interval', ['kind', 'name', 'node', 'start', 'end'])
+
+_COLORS = {'start-task': '#9e9e9e', 'prep': '#ff9800', 'task': '#2196f3', 'failed': '#f44336', 'queue': '#ffeb3b',
+           'wait': '#e0e0e0'}
+
+
+def collect_intervals(settings: dict, run_id: str) -> tuple:
+    """
+    Pull the timing of the jobs of a run, its nodes and its tasks from the Batch service. Returns the creation time of
+    the run, the intervals, and the task slots of every node.
+    """
+    from azure.batch.models import TaskListOptions, ComputeNodeListOptions
+    from miriam._utility import create_batch_client
+    from miriam.cache import to_utc
+    from miriam.jobs import list_shards
+    from miriam.sharding import get_test_pools
+
+    batch_client = create_batch_client(settings)
+    jobs = [batch_client.job.get(job_id) for job_id in [run_id] + list_shards(settings, run_id)]
+    origin = min(to_utc(job.creation_time) for job in jobs)
+    max_tasks = dict((pool['id'], int(pool['max-tasks'])) for pool in get_test_pools(settings))
+
+    def _offset(value) -> float:
+        return (to_utc(value) - origin).total_seconds() if value else None
+
+    intervals = []
+    slots = {}
+    for pool_id in set(job.pool_info.pool_id for job in jobs):
+        options = ComputeNodeListOptions(select='id,startTaskInfo')
+        for node in batch_client.compute_node.list(pool_id, compute_node_list_options=options):
+            slots[node.id] = max_tasks.get(pool_id, 1)
+            info = node.start_task_info
+            if info and info.start_time and info.end_time:
+                intervals.append(Interval('start-task', 'start task', node.id, _offset(info.start_time),
+                                          _offset(info.end_time)))
+
+    for job in jobs:
+        for status in batch_client.job.list_preparation_and_release_task_status(job.id):
+            info = status.job_preparation_task_execution_info
+            if info and info.start_time and info.end_time:
+                intervals.append(Interval('prep', job.id, status.node_id, _offset(info.start_time),
+                                          _offset(info.end_time)))
+
+        options = TaskListOptions(select='id,creationTime,executionInfo,nodeInfo', max_results=1000)
+        for task in batch_client.task.list(job.id, task_list_options=options):
+            info = task.execution_info
+            if task.id == 'test-creator' or not info or not info.start_time or not info.end_time:
+                continue
+            node_id = task.node_info.node_id if task.node_info else None
+            intervals.append(Interval('queue', task.id, node_id, _offset(task.creation_time),
+                                      _offset(info.start_time)))
+            intervals.append(Interval('task' if info.exit_code == 0 else 'failed', task.id, node_id,
+                                      _offset(info.start_time), _offset(info.end_time)))
+
+    return origin, intervals, slots
+
+
+def summarize_phases(intervals: list) -> dict:
+    """ The count, total, mean and longest seconds of every phase. """
+    phases = {}
+    for interval in intervals:
+        kind = 'task' if interval.kind == 'failed' else interval.kind
+        seconds = interval.end - interval.start
+        phase = phases.setdefault(kind, {'count': 0, 'total': 0.0, 'max': 0.0})
+        phase['count'] += 1
+        phase['total'] += seconds
+        phase['max'] = max(phase['max'], seconds)
+    for phase in phases.values():
+        phase['mean'] = phase['total'] / phase['count']
+    return phases
+
+
+def compute_utilization(intervals: list, slots: dict, bucket: float = 60) -> list:
+    """ The share of the task slots of all the nodes busy running tasks in every bucket of seconds of the run. """
+    tasks = [i for i in intervals if i.kind in ('task', 'failed')]
+    capacity = sum(slots.values()) * bucket
+    if not tasks or not capacity:
+        return []
+
+    busy = [0.0] * max(1, math.ceil(max(i.end for i in tasks) / bucket))
+    for interval in tasks:
+        index = int(interval.start // bucket)
+        while index * bucket < interval.end:
+            busy[index] += min(interval.end, (index + 1) * bucket) - max(interval.start, index * bucket)
+            index += 1
+    return [round(seconds / capacity, 4) for seconds in busy]
+
+
+def find_critical_path(intervals: list) -> list:
+    """
+    Walk back from the task which finished last. At every step, the start of a task is explained by the latest of:
+    the end of the previous task on its node, which freed the slot, the end of the preparation of its node, or its
+    addition to the job. Returns the intervals of the path in chronological order, with the waits between them.
+    """
+    tasks = [i for i in intervals if i.kind in ('task', 'failed')]
+    if not tasks:
+        return []
+
+    by_node = {}
+    for interval in sorted(tasks, key=lambda i: i.end):
+        by_node.setdefault(interval.node, []).append(interval)
+    ends = dict((node, [i.end for i in node_tasks]) for node, node_tasks in by_node.items())
+    preps = dict((i.node, i) for i in intervals if i.kind == 'prep')
+    queued = dict((i.name, i) for i in intervals if i.kind == 'queue')
+
+    path = []
+    visited = set()
+    current = max(tasks, key=lambda i: i.end)
+    while current:
+        path.append(current)
+        visited.add(id(current))
+        candidates = []
+
+        # a task ending when it starts, such as one failing at once, would otherwise be its own predecessor
+        index = bisect_right(ends[current.node], current.start) - 1
+        while index >= 0 and id(by_node[current.node][index]) in visited:
+            index -= 1
+        if index >= 0:
+            candidates.append(by_node[current.node][index])
+        if current.node in preps and preps[current.node].end <= current.start:
+            candidates.append(preps[current.node])
+        if current.name in queued:
+            candidates.append(Interval('scheduling', 'added to the job', current.node, 0.0,
+                                       queued[current.name].start))
+        if not candidates:
+            break
+
+        previous = max(candidates, key=lambda i: i.end)
+        if current.start > previous.end:
+            path.append(Interval('wait', 'wait', current.node, previous.end, current.start))
+        current = previous if previous.kind in ('task', 'failed') else None
+        if not current:
+            path.append(previous)
+
+    path.reverse()
+    return path
+
+
+def write_timeline(path: str, run_id: str, intervals: list, critical_path: list) -> None:
+    """ Draw the intervals of every node on a time line in an SVG embedded in an HTML page. """
+    from html import escape
+
+    nodes = sorted(set(i.node for i in intervals if i.node))
+    rows = dict((node, index) for index, node in enumerate(nodes))
+    end = max((i.end for i in intervals), default=0.0) or 1.0
+    scale = 1600 / end
+    critical = set((i.kind, i.name, i.node, i.start) for i in critical_path)
+
+    with open(path, 'w') as page:
+        page.write(f'<html>\n<head>\n<title>Timeline {escape(run_id)}</title>\n</head>\n<body>\n'
+                   f'<h1>Timeline of {escape(run_id)}</h1>\n'
+                   f'<svg width="1800" height="{len(nodes) * 20 + 40}" font-family="sans-serif" font-size="10">\n')
+        for node, index in rows.items():
+            page.write(f'<text x="0" y="{index * 20 + 14}">{escape(node)}</text>\n')
+        for interval in intervals:
+            if interval.kind == 'queue' or interval.node not in rows:
+                continue
+            stroke = ' stroke="black" stroke-width="2"' if (interval.kind, interval.name, interval.node,
+                                                            interval.start) in critical else ''
+            page.write('<rect x="{:.1f}" y="{}" width="{:.1f}" height="16" fill="{}"{}><title>{} {} {:.1f}s</title>'
+                       '</rect>\n'.format(200 + interval.start * scale, rows[interval.node] * 20 + 2,
+                                          max(1.0, (interval.end - interval.start) * scale), _COLORS[interval.kind],
+                                          stroke, interval.kind, escape(interval.name),
+                                          interval.end - interval.start))
+        page.write('</svg>\n</body>\n</html>\n')
+
+
+def _timing(args: argparse.Namespace) -> None:
+    import json
+    import tabulate
+    from miriam._utility import load_settings
+
+    settings = load_settings(args.config)
+    origin, intervals, slots = collect_intervals(settings, args.run_id)
+
+    phases = summarize_phases(intervals)
+    utilization = compute_utilization(intervals, slots, args.bucket)
+    critical_path = find_critical_path(intervals)
+    wall_time = max((i.end for i in intervals), default=0.0)
+
+    print(f'Wall time: {wall_time:.0f} seconds on {len(slots)} nodes. Mean utilization: '
+          f'{sum(utilization) / len(utilization) if utilization else 0:.1%}')
+    print(tabulate.tabulate([[kind, phase['count'], phase['total'], phase['mean'], phase['max']]
+                             for kind, phase in sorted(phases.items())],
+                            headers=['Phase', 'Count', 'Total (s)', 'Mean (s)', 'Max (s)'], floatfmt='.1f'))
+    print('\nCritical path:')
+    print(tabulate.tabulate([[i.kind, i.name, i.node, i.start, i.end - i.start] for i in critical_path],
+                            headers=['Phase', 'Name', 'Node', 'Start (s)', 'Seconds'], floatfmt='.1f'))
+
+    with open(f'timing-{args.run_id}.json', 'w') as json_file:
+        json.dump({'run_id': args.run_id,
+                   'created': origin.isoformat() + 'Z',
+                   'wall_time': wall_time,
+                   'phases': phases,
+                   'utilization': {'bucket': args.bucket, 'values': utilization},
+                   'critical_path': [i._asdict() for i in critical_path],
+                   'intervals': [i._asdict() for i in intervals]}, json_file)
+    if args.html:
+        write_timeline(f'timing-{args.run_id}.html', args.run_id, intervals, critical_path)
+
+
+def setup(subparsers) -> None:
+    parser = subparsers.add_parser('timing', help='Break down the wall time of a test job by phase.')
+    parser.add_argument('run_id', help='The test run id to analyze.')
+    parser.add_argument('--bucket', type=float, default=60, metavar='SECONDS',
+                        help='The time resolution of the node utilization. Default: 60')
+    parser.add_argument('--html', action='store_true', help='Also draw the time line of the nodes in an HTML page.')
+    parser.set_defaults(func=_timing)
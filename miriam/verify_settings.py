@@ -2,15 +2,14 @@ import argparse
 
 
 def verify_settings(args: argparse.Namespace) -> dict:
-    import yaml
     import sys
-    from miriam._utility import create_storage_client, create_batch_client
+    from miriam._utility import create_storage_client, create_batch_client, load_settings
 
     from azure.common import AzureHttpError
     from azure.batch.models import BatchErrorException
 
     try:
-        settings = yaml.load(args.config)
+        settings = load_settings(args.config)
         batch_client = create_batch_client(settings)
         batch_client.pool.list()
         next(batch_client.account.list_node_agent_skus())
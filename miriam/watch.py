@@ -0,0 +1,109 @@
+import argparse
+from collections import namedtuple
+
+# The poll interval is bounded by min_interval and max_interval, in seconds, and the throughput is measured over the
+# last window seconds. If failover is set, the queued tasks of preempted low-priority shards are moved on every poll.
+WatchOptions = namedtuple('WatchOptions', ['min_interval', 'max_interval', 'window', 'failover'])
+WatchOptions.__new__.__defaults__ = (5, 60, 300, False)
+
+
+def _format_duration(seconds: float) -> str:
+    if seconds is None:
+        return '--:--:--'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02}:{minutes:02}:{seconds:02}'
+
+
+def watch_run(settings: dict, run_id: str, cache, options: WatchOptions = None, on_poll=None) -> dict:
+    """
+    Follow a test run until the jobs of all its shards are completed. Every poll synchronizes only the tasks changed
+    since the last poll into the results cache, so the number of calls to the Batch service does not grow with the
+    number of tasks.
+
+    The poll interval is halved when tests complete and grows by half when nothing changes, within the bounds of the
+    options. Returns the final counts.
+    """
+    import time
+    from collections import deque
+    from miriam.cache import count_tasks, get_run
+    from miriam.report import sync_results
+    from miriam.failover import failover_shards
+    from miriam.jobs import list_shards
+
+    options = options or WatchOptions()
+    samples = deque()
+    interval = options.min_interval
+    job_ids = [run_id] + list_shards(settings, run_id)
+
+    while True:
+        if options.failover and len(job_ids) > 1:
+            failover_shards(settings, run_id, cache)
+
+        counts = dict.fromkeys(('passed', 'failed', 'running', 'queued'), 0)
+        for job_id in job_ids:
+            sync_results(settings, cache, job_id)
+            for key, value in count_tasks(cache, job_id).items():
+                counts[key] += value
+        now = time.time()
+
+        finished = counts['passed'] + counts['failed']
+        if samples and finished > samples[-1][1]:
+            interval = max(options.min_interval, interval / 2)
+        else:
+            interval = min(options.max_interval, interval * 1.5)
+
+        samples.append((now, finished))
+        while len(samples) > 2 and samples[0][0] < now - options.window:
+            samples.popleft()
+
+        elapsed = now - samples[0][0]
+        counts['throughput'] = (finished - samples[0][1]) * 60 / elapsed if elapsed else 0.0
+        remaining = counts['running'] + counts['queued']
+        counts['eta'] = remaining * 60 / counts['throughput'] if counts['throughput'] else None
+
+        if on_poll:
+            on_poll(counts)
+
+        if all(get_run(cache, job_id).completed for job_id in job_ids):
+            return counts
+
+        time.sleep(interval)
+
+
+def _print_progress(counts: dict) -> None:
+    from datetime import datetime
+
+    print('{}  passed {:>6}  failed {:>5}  running {:>5}  queued {:>6}  {:>7.1f} tests/min  ETA {}'.format(
+        datetime.now().strftime('%H:%M:%S'), counts['passed'], counts['failed'], counts['running'], counts['queued'],
+        counts['throughput'], _format_duration(counts['eta'])), flush=True)
+
+
+def _watch(args: argparse.Namespace) -> None:
+    import sys
+    from miriam._utility import load_settings
+    from miriam.cache import open_cache
+
+    settings = load_settings(args.config)
+    options = WatchOptions(min_interval=args.min_interval, max_interval=args.max_interval, failover=args.failover)
+    counts = watch_run(settings, args.run_id, open_cache(args.cache), options, on_poll=_print_progress)
+
+    print(f'Run {args.run_id} is completed. {counts["passed"]} passed, {counts["failed"]} failed.')
+    sys.exit(1 if counts['failed'] else 0)
+
+
+def setup(subparsers) -> None:
+    from miriam.cache import DEFAULT_CACHE_PATH
+
+    parser = subparsers.add_parser('watch', help='Follow the progress of a test job until it is completed.')
+    parser.add_argument('run_id', help='The test run id to follow.')
+    parser.add_argument('--min-interval', type=float, default=5, metavar='SECONDS',
+                        help='The shortest time between two polls. Default: 5')
+    parser.add_argument('--max-interval', type=float, default=60, metavar='SECONDS',
+                        help='The longest time between two polls. Default: 60')
+    parser.add_argument('--failover', action='store_true',
+                        help='Move the queued tasks of the shards on preempted low-priority nodes to the shards on '
+                             'dedicated nodes.')
+    parser.add_argument('--cache', metavar='PATH',
+                        help=f'The path of the local results cache. Default: {DEFAULT_CACHE_PATH}')
+    parser.set_defaults(func=_watch)
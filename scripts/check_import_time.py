@@ -0,0 +1,90 @@
+"""
+Import time regression check of the Miriam command line.
+
+Runs the help of the command line and of the light sub commands in fresh interpreters and fails if any of them
+imports a heavy dependency or exceeds the time budget. On Python 3.7 and later the slowest imports, as reported by
+-X importtime, are listed to help finding the culprit.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('azure', 'msrest', 'requests', 'yaml', 'tabulate')
+
+PROBES = [
+    ['--help'],
+    ['create-default', '--help'],
+    ['report', '--help'],
+    ['watch', '--help'],
+]
+
+PROBE_MARKER = 'MIRIAM-PROBE '
+
+PROBE_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+sys.argv = ['mir'] + {argv!r}
+try:
+    from miriam.__main__ import program
+    program()
+except SystemExit:
+    pass
+print({marker!r} + json.dumps([time.perf_counter() - start, sorted(sys.modules)]))
+"""
+
+
+def _slowest_imports(stderr: str, count: int = 5) -> list:
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def _run_probe(argv: list) -> tuple:
+    command = [sys.executable]
+    if sys.version_info >= (3, 7):
+        command += ['-X', 'importtime']
+    command += ['-c', PROBE_SCRIPT.format(argv=argv, marker=PROBE_MARKER)]
+
+    result = subprocess.run(command, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    probe = next(line for line in result.stdout.splitlines() if line.startswith(PROBE_MARKER))
+    elapsed, modules = json.loads(probe[len(PROBE_MARKER):])
+    return elapsed, modules, _slowest_imports(result.stderr)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--budget-ms', type=float, default=300,
+                        help='The longest time a probe may take, in milliseconds. Default: 300')
+    args = parser.parse_args()
+
+    failed = False
+    for argv in PROBES:
+        elapsed, modules, slowest = _run_probe(argv)
+        heavy = sorted(set(module.split('.')[0] for module in modules) & set(HEAVY_MODULES))
+        status = 'ok'
+        if heavy:
+            status = 'imports ' + ', '.join(heavy)
+        elif elapsed * 1000 > args.budget_ms:
+            status = 'over budget'
+        failed = failed or status != 'ok'
+
+        print('mir {:<24} {:>8.1f} ms  {}'.format(' '.join(argv), elapsed * 1000, status))
+        if status != 'ok':
+            for cumulative, name in slowest:
+                print('    {:>8.1f} ms  {}'.format(cumulative / 1000, name))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -35,7 +35,7 @@ DEPENDENCIES = [
     'pyyaml',
     'requests',
     'tabulate'
-    # 'pyodbc==3.1.1',
+    # 'pyodbc>=4.0.19', needed by the export to SQL only
 ]
 
 setup(name='Miriam',